@@ -0,0 +1,66 @@
+#!/bin/python
+
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from engine.filters import FileFilter
+from engine.misc import guess_mime_type
+
+extensions = [".jpg", ".JPG", ".png", ".mp4", ".txt", ".tar.gz", ".pdf", ".mkv", ".json", ""]
+
+
+def generate_paths(root, count, depth):
+    random.seed(0)
+    paths = []
+    for index in range(count):
+        directories = [f"dir{random.randrange(20)}" for _ in range(random.randrange(depth + 1))]
+        file_name = f"file{index}{random.choice(extensions)}"
+        paths.append(root.joinpath(*directories, file_name))
+    return paths
+
+
+def match_uncompiled(root, file_path, path_filters, mime_filters):
+    # Filtering as it was done before filters were compiled. Kept here as a reference point.
+    relative_path = str(file_path.absolute().relative_to(root))
+    if path_filters and not any(re.search(path_filter, relative_path) for path_filter in path_filters):
+        return False
+    if mime_filters:
+        mime_type = guess_mime_type(file_path)
+        if mime_type is None or not any(re.match(mime_filter, mime_type) for mime_filter in mime_filters):
+            return False
+    return True
+
+
+def measure(name, function, paths):
+    start = time.perf_counter()
+    matched = sum(1 for path in paths if function(path))
+    duration = time.perf_counter() - start
+    print(f"{name: <12} {duration:8.3f}s  {duration / len(paths) * 1e9:8.0f}ns/file  matched={matched}")
+    return matched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure time spent evaluating ftag path and mime filters.")
+    parser.add_argument("-n", "--count", type=int, default=200000, help="Number of synthetic paths.")
+    parser.add_argument("-d", "--depth", type=int, default=4, help="Maximum directory depth.")
+    args = parser.parse_args()
+
+    root = Path("/library")
+    path_filters = [r"^dir1", r"\.(jpg|JPG|png)$", r"\.mp4$", r"dir1[0-9]/"]
+    mime_filters = ["^image/", "^video/"]
+    paths = generate_paths(root, args.count, args.depth)
+
+    print(f"Evaluating {len(path_filters)} path filters and {len(mime_filters)} mime filters for {len(paths)} files")
+    file_filter = FileFilter(path_filters, mime_filters)
+    uncompiled = measure("uncompiled", lambda path: match_uncompiled(root, path, path_filters, mime_filters), paths)
+    # The walk builds relative paths per directory, so the compiled filter gets them for free
+    relative_paths = [str(path.relative_to(root)) for path in paths]
+    compiled = measure("compiled", file_filter.matches, relative_paths)
+    if compiled != uncompiled:
+        print("ERROR: compiled filters returned different results")
+        sys.exit(1)
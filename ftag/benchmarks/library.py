@@ -0,0 +1,84 @@
+#!/bin/python
+
+import argparse
+import math
+import os
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from engine import TagEngine, TagEngineStorage, TagRecord
+
+
+def get_file_size(min_size, max_size):
+    # Log-uniform distribution. Most files are small, some are large, like in a typical media library.
+    return int(math.exp(random.uniform(math.log(min_size), math.log(max_size))))
+
+
+def generate_files(root, count, depth, min_size, max_size):
+    directories = [f"dir{index}" for index in range(max(1, count // 50))]
+    paths = []
+    for index in range(count):
+        path_directories = [random.choice(directories) for _ in range(random.randint(1, depth))]
+        file_path = root.joinpath(*path_directories, f"file{index}.dat")
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(file_path, "wb") as file:
+            file.write(random.randbytes(get_file_size(min_size, max_size)))
+        paths.append(file_path)
+    return paths
+
+
+def generate_library(root, count, depth=3, min_size=1024, max_size=256 * 1024, num_categories=5, num_tags=20, tagged_fraction=0.8, storage="json", seed=0):
+    # Creates a directory tree with random files and an ftag database, where a fraction of files is tagged.
+    # Returns paths of the generated files.
+    random.seed(seed)
+    root = Path(root).absolute()
+    root.mkdir(parents=True, exist_ok=True)
+    paths = generate_files(root, count, depth, min_size, max_size)
+
+    previous_directory = os.getcwd()
+    os.chdir(root)
+    try:
+        engine = TagEngine()
+        engine.initialize()
+        categories = [f"category{c}" for c in range(num_categories)]
+        for category in categories:
+            engine.add_category(category)
+            for t in range(num_tags):
+                engine.add_tag(category, f"tag{t}")
+
+        records = []
+        for file_path in paths:
+            if random.random() >= tagged_fraction:
+                continue
+            for category in categories:
+                tags = random.sample(range(num_tags), random.randint(0, 3))
+                records.append(TagRecord(str(file_path), str(file_path), category, [f"tag{t}" for t in tags]))
+        engine.import_tags(records)
+        engine.save()
+        if storage != TagEngineStorage.Json.value:
+            engine.migrate(TagEngineStorage(storage))
+    finally:
+        os.chdir(previous_directory)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic library of random files with an ftag database.")
+    parser.add_argument("root", type=Path, help="Directory to create the library in.")
+    parser.add_argument("-n", "--count", type=int, default=2000, help="Number of files.")
+    parser.add_argument("-d", "--depth", type=int, default=3, help="Maximum directory depth.")
+    parser.add_argument("--min_size", type=int, default=1024, help="Minimum file size in bytes.")
+    parser.add_argument("--max_size", type=int, default=256 * 1024, help="Maximum file size in bytes.")
+    parser.add_argument("-c", "--categories", type=int, default=5, help="Number of categories.")
+    parser.add_argument("-t", "--tags", type=int, default=20, help="Number of tags per category.")
+    parser.add_argument("--tagged", type=float, default=0.8, help="Fraction of tagged files.")
+    parser.add_argument("--storage", choices=[s.value for s in TagEngineStorage], default="json", help="Storage of the database.")
+    args = parser.parse_args()
+
+    if args.root.exists() and any(args.root.iterdir()):
+        print(f"ERROR: {args.root} is not empty")
+        sys.exit(1)
+    generate_library(args.root, args.count, args.depth, args.min_size, args.max_size, args.categories, args.tags, args.tagged, args.storage)
+    print(f"Generated {args.count} files in {args.root}")
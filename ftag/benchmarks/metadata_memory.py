@@ -0,0 +1,109 @@
+#!/bin/python
+
+import argparse
+import collections
+import gc
+import hashlib
+import json
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from engine.metadata import TagEngineMetadata
+
+
+def generate_content(count, num_categories, num_tags):
+    random.seed(0)
+    categories = {f"category{c}": [f"tag{c}_{t}" for t in range(num_tags)] for c in range(num_categories)}
+    files = {}
+    for index in range(count):
+        file_hash = hashlib.blake2b(str(index).encode()).hexdigest()[0:48]
+        tags = {}
+        for category, values in categories.items():
+            if random.random() < 0.8:
+                tags[category] = random.sample(values, random.randint(0, 3))
+        directories = [f"dir{random.randrange(50)}" for _ in range(random.randint(1, 4))]
+        files[file_hash] = {"path": "/".join(directories + [f"file{index}.jpg"]), "tags": tags}
+    return {"files": files, "filters": {"mime": [], "path": []}, "tags": categories, "version": 1, "queries": {}}
+
+
+def load_nested(serialized_content):
+    # Layout used before the compact representation: nested dicts plus an inverted index of hash sets
+    content = json.loads(serialized_content)
+    tag_index = collections.defaultdict(set)
+    for file_hash, file_metadata in content["files"].items():
+        for category, values in file_metadata["tags"].items():
+            tag_index[(category, None)].add(file_hash)
+            for value in values:
+                tag_index[(category, value)].add(file_hash)
+    return content, tag_index
+
+
+def query_nested(loaded, keys):
+    _, tag_index = loaded
+    hash_sets = sorted((tag_index.get(key, set()) for key in keys), key=len)
+    return len(hash_sets[0].intersection(*hash_sets[1:]))
+
+
+def load_compact(serialized_content):
+    metadata = TagEngineMetadata(None)
+    metadata.import_content(json.loads(serialized_content))
+    return metadata
+
+
+def query_compact(metadata, keys):
+    rules = {}
+    for category, value in keys:
+        rules.setdefault(category, [])
+        if value is not None:
+            rules[category].append(value)
+    return len(metadata._get_hashes_matching_query(rules))
+
+
+def measure(name, load, query, serialized_content, keys):
+    # Memory is traced in a separate load, tracing slows down allocations a lot and would distort the timing
+    gc.collect()
+    tracemalloc.start()
+    loaded = load(serialized_content)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+
+    gc.collect()
+    start = time.perf_counter()
+    loaded = load(serialized_content)
+    load_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matched = query(loaded, keys)
+    first_query_duration = time.perf_counter() - start
+    start = time.perf_counter()
+    query(loaded, keys)
+    query_duration = time.perf_counter() - start
+    print(
+        f"{name: <8} resident={current / 2**20:8.1f}MiB  peak={peak / 2**20:8.1f}MiB  load={load_duration:6.2f}s  "
+        f"first query={first_query_duration * 1e3:7.1f}ms  query={query_duration * 1e3:7.1f}ms  matched={matched}"
+    )
+    return matched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare memory used by nested dict and compact ftag metadata.")
+    parser.add_argument("-n", "--count", type=int, default=200000, help="Number of synthetic files.")
+    parser.add_argument("-c", "--categories", type=int, default=5, help="Number of categories.")
+    parser.add_argument("-t", "--tags", type=int, default=20, help="Number of tags per category.")
+    args = parser.parse_args()
+
+    serialized_content = json.dumps(generate_content(args.count, args.categories, args.tags))
+    keys = [("category0", None), ("category0", "tag0_1"), ("category1", "tag1_2")]
+
+    print(f"Loading {args.count} files with {args.categories} categories of {args.tags} tags")
+    nested = measure("nested", load_nested, query_nested, serialized_content, keys)
+    compact = measure("compact", load_compact, query_compact, serialized_content, keys)
+    if nested != compact:
+        print("ERROR: compact metadata returned different results")
+        sys.exit(1)
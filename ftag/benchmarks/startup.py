@@ -0,0 +1,118 @@
+#!/bin/python
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from engine import TagEngine, TagEngineStorage
+from engine.engine import metadata_directory_name, metadata_file_name
+from metadata_memory import generate_content
+
+cli_path = Path(__file__).resolve().parent.parent / "ftag_cli.py"
+config_budget = 0.05
+
+# Configuration commands must stay within the budget no matter how large the database is. Other commands are
+# measured for comparison.
+commands = [
+    ("help", ["--help"], False),
+    ("add_category", ["-c", "benchmark_category"], True),
+    ("add_mime_filter", ["-m", "^image/"], True),
+    ("add_path_filter", ["-p", "\\.jpg$"], True),
+    ("search", ["-s", "category0:tag0_1"], False),
+]
+
+
+def create_database(root, count, num_categories, num_tags, storage):
+    # Only the database is generated, files don't have to exist for configuration commands
+    content = generate_content(count, num_categories, num_tags)
+    content["files"] = content.pop("files")  # Snapshots are written with files last
+    metadata_directory = root / metadata_directory_name
+    metadata_directory.mkdir(parents=True)
+    with open(metadata_directory / metadata_file_name, "w") as file:
+        json.dump(content, file, indent=4)
+
+    if storage != TagEngineStorage.Json.value:
+        previous_directory = os.getcwd()
+        os.chdir(root)
+        try:
+            TagEngine().migrate(TagEngineStorage(storage))
+        finally:
+            os.chdir(previous_directory)
+
+
+def measure_command(root, arguments, repeat):
+    # Every run starts from the same database, so the journal doesn't grow and trigger a compaction
+    metadata_directory = root / metadata_directory_name
+    backup_directory = root / "metadata_backup"
+    shutil.copytree(metadata_directory, backup_directory)
+    durations = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, str(cli_path)] + arguments, cwd=root, stdout=subprocess.DEVNULL, check=True)
+            durations.append(time.perf_counter() - start)
+            shutil.rmtree(metadata_directory)
+            shutil.copytree(backup_directory, metadata_directory)
+    finally:
+        shutil.rmtree(backup_directory)
+    return durations
+
+
+def measure_interpreter(repeat):
+    # Startup of a bare interpreter, which no command can beat
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure startup time of ftag commands on a large synthetic database.")
+    parser.add_argument("-n", "--count", type=int, default=200000, help="Number of files in the database.")
+    parser.add_argument("-c", "--categories", type=int, default=5, help="Number of categories.")
+    parser.add_argument("-t", "--tags", type=int, default=20, help="Number of tags per category.")
+    parser.add_argument("--storage", choices=[s.value for s in TagEngineStorage], default="json", help="Storage of the database.")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of runs of every command.")
+    parser.add_argument("-o", "--output", type=Path, help="File to write the results to as JSON.")
+    args = parser.parse_args()
+
+    root = Path(tempfile.mkdtemp(prefix="ftag_startup_"))
+    results = {}
+    try:
+        print(f"Generating database of {args.count} files in {root}")
+        create_database(root, args.count, args.categories, args.tags, args.storage)
+        print(f"Database size {sum(f.stat().st_size for f in (root / metadata_directory_name).rglob('*') if f.is_file()) / 2**20:.1f} MiB")
+
+        durations = measure_interpreter(args.repeat)
+        results["interpreter"] = {"runs": durations, "median": statistics.median(durations)}
+        print(f"{'interpreter': <16} median={statistics.median(durations) * 1e3:8.1f}ms")
+
+        over_budget = False
+        for name, arguments, in_budget in commands:
+            durations = measure_command(root, arguments, args.repeat)
+            median = statistics.median(durations)
+            results[name] = {"runs": durations, "median": median}
+            note = ""
+            if in_budget and median > config_budget:
+                note = f"  over {config_budget * 1e3:.0f}ms budget"
+                over_budget = True
+            print(f"{name: <16} median={median * 1e3:8.1f}ms{note}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output is not None:
+        parameters = {"count": args.count, "categories": args.categories, "tags": args.tags, "storage": args.storage, "repeat": args.repeat}
+        with open(args.output, "w") as file:
+            json.dump({"parameters": parameters, "budget": config_budget, "results": results}, file, indent=4)
+    if over_budget:
+        sys.exit(1)
@@ -0,0 +1,147 @@
+#!/bin/python
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from engine import TagEngine, TagEngineStorage
+from library import generate_library
+
+
+def measure(results, name, function, repeat):
+    # Every run gets a fresh setup from the function, only the returned operation is timed
+    durations = []
+    for run in range(repeat):
+        operation = function(run)
+        start = time.perf_counter()
+        operation()
+        durations.append(time.perf_counter() - start)
+    results[name] = {
+        "runs": durations,
+        "min": min(durations),
+        "median": statistics.median(durations),
+    }
+    print(f"{name: <24} min={min(durations):8.3f}s  median={statistics.median(durations):8.3f}s")
+
+
+def get_git_commit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True)
+        return output.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def remove_fingerprint_cache(root):
+    for file_path in (root / ".ftag").glob("fingerprints*"):
+        file_path.unlink()
+
+
+def run_benchmarks(root, paths, repeat):
+    results = {}
+    os.chdir(root)
+
+    def cold_statistics(run):
+        remove_fingerprint_cache(root)
+        engine = TagEngine()
+        return lambda: (engine.get_untagged_files_statistics(), engine.save_fingerprint_cache())
+
+    def warm_statistics(run):
+        engine = TagEngine()
+        return engine.get_untagged_files_statistics
+
+    def generate_new(run):
+        shutil.rmtree(root / "ftags", ignore_errors=True)
+        engine = TagEngine()
+        return engine.generate_all_symlinks
+
+    def generate_unchanged(run):
+        engine = TagEngine()
+        return engine.generate_all_symlinks
+
+    def generate_rebuild(run):
+        engine = TagEngine()
+        return lambda: engine.generate_all_symlinks(reconcile=False)
+
+    def add_query(run):
+        engine = TagEngine()
+        return lambda: (engine.add_query(f"benchmark{run}", "category0:tag1 OR (category1:tag2 AND NOT category2:*)"), engine.save())
+
+    def set_tags(run):
+        engine = TagEngine()
+        file_entry = engine.resolve_file(paths[run % len(paths)])
+        return lambda: (engine.set_tags(file_entry, {"category0": [f"tag{run % 20}"]}), engine.save())
+
+    def save(run):
+        engine = TagEngine()
+        engine.add_tag("category0", f"benchmark{run}_{time.time_ns()}")
+        return engine.save
+
+    measure(results, "load", lambda run: TagEngine, repeat)
+    measure(results, "untagged_stats_cold", cold_statistics, repeat)
+    measure(results, "untagged_stats_warm", warm_statistics, repeat)
+    measure(results, "generate_new", generate_new, repeat)
+    measure(results, "generate_unchanged", generate_unchanged, repeat)
+    measure(results, "generate_rebuild", generate_rebuild, repeat)
+    measure(results, "add_query", add_query, repeat)
+    measure(results, "set_tags", set_tags, repeat)
+    measure(results, "save", save, repeat)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ftag benchmarks on a synthetic library and store the results as JSON.")
+    parser.add_argument("-n", "--count", type=int, default=2000, help="Number of files.")
+    parser.add_argument("-d", "--depth", type=int, default=3, help="Maximum directory depth.")
+    parser.add_argument("--min_size", type=int, default=1024, help="Minimum file size in bytes.")
+    parser.add_argument("--max_size", type=int, default=256 * 1024, help="Maximum file size in bytes.")
+    parser.add_argument("-c", "--categories", type=int, default=5, help="Number of categories.")
+    parser.add_argument("-t", "--tags", type=int, default=20, help="Number of tags per category.")
+    parser.add_argument("--storage", choices=[s.value for s in TagEngineStorage], default="json", help="Storage of the database.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of runs of every benchmark.")
+    parser.add_argument("-o", "--output", type=Path, default=Path("ftag_benchmark.json"), help="File to write the results to.")
+    parser.add_argument("--root", type=Path, help="Directory for the library. Temporary directory is used and removed by default.")
+    args = parser.parse_args()
+
+    output_path = args.output.absolute()
+    root = args.root.absolute() if args.root else Path(tempfile.mkdtemp(prefix="ftag_benchmark_"))
+    try:
+        print(f"Generating {args.count} files in {root}")
+        start = time.perf_counter()
+        paths = generate_library(root, args.count, args.depth, args.min_size, args.max_size, args.categories, args.tags, storage=args.storage)
+        print(f"Generated in {time.perf_counter() - start:.1f}s")
+        results = run_benchmarks(root, paths, args.repeat)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "count": args.count,
+            "depth": args.depth,
+            "min_size": args.min_size,
+            "max_size": args.max_size,
+            "categories": args.categories,
+            "tags": args.tags,
+            "storage": args.storage,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(output_path, "w") as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {output_path}")
@@ -1,3 +1,9 @@
-from .engine import TagEngine, TagEngineState
+from .engine import TagEngine, TagEngineState, TagEngineStorage
 from .exception import TagEngineException
 from .metadata import TagEngineMetadata
+from .metadata_sqlite import SqliteTagEngineMetadata
+from .metadata_sharded import ShardedTagEngineMetadata
+from .file_entry import FileEntry
+from .tag_import import TagRecord, read_tag_records
+from .misc import fingerprint_strategies
+from .profiler import profiler, profile_environment_variable
@@ -1,18 +1,36 @@
+import collections
+import contextlib
 import enum
 import os
 import random
-import re
+import time
 from pathlib import Path
 
 from engine.exception import TagEngineException
-from engine.metadata import TagEngineMetadata
-from engine.misc import get_file_hash, get_file_mime_type
+from engine.file_entry import FileEntry
+from engine.fingerprint_cache import FingerprintCache
+from engine.hash_pipeline import default_worker_count, hash_files, hash_whole_files, prefetch_files
+from engine.lock import MetadataLock
+from engine.metadata import TagEngineMetadata, journal_file_name
+from engine.metadata_sharded import ShardedTagEngineMetadata
+from engine.metadata_sqlite import SqliteTagEngineMetadata
+from engine.misc import fingerprint_strategies, get_file_hash, probe_file
+from engine.profiler import profiler
 from engine.symlinker import Symlinker
+from engine.walker import is_ignored_file, walk_files
 
 metadata_directory_name = ".ftag"
 tagged_directory_name = "ftags"
 metadata_file_name = "db.json"
 metadata_file_name_tmp = "db_tmp.json"
+metadata_sqlite_file_name = "db.sqlite"
+metadata_sqlite_file_name_tmp = "db_tmp.sqlite"
+metadata_manifest_file_name = "manifest.json"
+metadata_manifest_file_name_tmp = "manifest_tmp.json"
+watch_max_latency_factor = 10
+fingerprint_cache_file_name = "fingerprints.json"
+fingerprint_cache_file_name_tmp = "fingerprints_tmp.json"
+lock_file_name = "lock"
 
 
 class TagEngineState(enum.Enum):
@@ -21,41 +39,108 @@ class TagEngineState(enum.Enum):
     Loaded = enum.auto()
 
 
+class TagEngineStorage(enum.Enum):
+    Json = "json"
+    Sqlite = "sqlite"
+    Sharded = "sharded"
+
+
+# Order matters. If multiple files are present (e.g. an interrupted migration), the first one is used.
+metadata_file_names = {
+    TagEngineStorage.Sqlite: (metadata_sqlite_file_name, metadata_sqlite_file_name_tmp),
+    TagEngineStorage.Sharded: (metadata_manifest_file_name, metadata_manifest_file_name_tmp),
+    TagEngineStorage.Json: (metadata_file_name, metadata_file_name_tmp),
+}
+
+
 class TagEngine:
     def __init__(self):
         self._root_dir = None
         self._metadata = None
+        self._fingerprint_cache = None
+        self._symlinker = None
+        self._lock = None
+        self._worker_count = default_worker_count
 
-        self._root_dir = TagEngine._find_root_dir()
+        self._root_dir, self._storage = TagEngine._find_root_dir()
         if self._root_dir is not None:
-            self._metadata = TagEngineMetadata(self.get_metadata_file())
+            self._lock = MetadataLock(self._get_metadata_dir_path() / lock_file_name)
+            self._fingerprint_cache = self._create_fingerprint_cache()
+            with profiler.phase("metadata.load"):
+                self._metadata = self._load_metadata()
+            self._fingerprint_cache.set_strategy(self._metadata.get_fingerprint_strategy())
 
             if self._metadata is None:
                 self._state = TagEngineState.InvalidData
             else:
                 self._state = TagEngineState.Loaded
+            self._symlinker = Symlinker(self._root_dir / tagged_directory_name)
         else:
             self._state = TagEngineState.NotLoaded
-        self._symlinker = Symlinker(self._root_dir / tagged_directory_name)
 
     def initialize(self):
         self._root_dir = Path(os.path.abspath(os.curdir))
-        self._metadata = TagEngineMetadata(None)
+        self._storage = TagEngineStorage.Json
+        self._lock = MetadataLock(self._get_metadata_dir_path() / lock_file_name)
+        self._fingerprint_cache = self._create_fingerprint_cache()
+        self._metadata = TagEngineMetadata(None, self._fingerprint_cache)
+        self._fingerprint_cache.set_strategy(self._metadata.get_fingerprint_strategy())
         self._symlinker = Symlinker(self._root_dir / tagged_directory_name)
         self._state = TagEngineState.Loaded
 
+    def _create_fingerprint_cache(self):
+        metadata_dir = self._get_metadata_dir_path()
+        cache_file = metadata_dir / fingerprint_cache_file_name
+        tmp_file = metadata_dir / fingerprint_cache_file_name_tmp
+        return FingerprintCache(cache_file, tmp_file)
+
+    def _create_metadata(self, storage, metadata_file):
+        if storage == TagEngineStorage.Sqlite:
+            return SqliteTagEngineMetadata(metadata_file, self._fingerprint_cache)
+        elif storage == TagEngineStorage.Sharded:
+            return ShardedTagEngineMetadata(metadata_file, self._fingerprint_cache)
+        else:
+            return TagEngineMetadata(metadata_file, self._fingerprint_cache)
+
+    def _lock_metadata(self, exclusive=True):
+        # SQLite does its own locking. Holding both locks could deadlock with a process taking them in the other order.
+        if self._storage == TagEngineStorage.Sqlite:
+            return contextlib.nullcontext()
+        return self._lock.hold(exclusive)
+
+    def _load_metadata(self):
+        with self._lock_metadata(exclusive=False):
+            return self._create_metadata(self._storage, self.get_metadata_file())
+
+    def _merge_stored_metadata(self):
+        # Other processes may have saved the database since it was loaded. The version is checked under the lock,
+        # and if it differs, the stored metadata is loaded and unsaved changes are merged into it. SQLite is
+        # updated row by row in its own transactions, so it doesn't need this.
+        if self._storage == TagEngineStorage.Sqlite or not self.get_metadata_file().is_file():
+            return
+        stored_metadata = self._create_metadata(self._storage, self.get_metadata_file())
+        if stored_metadata.get_version() != self._metadata.get_version():
+            profiler.count("metadata_merges")
+            old_metadata = self._metadata
+            self._metadata = old_metadata.merge_into(stored_metadata)
+            old_metadata.close()
+            self._fingerprint_cache.set_strategy(self._metadata.get_fingerprint_strategy())
+        else:
+            stored_metadata.close()
+
     @staticmethod
     def _find_root_dir():
         previous_path = None
         current_path = Path(os.path.abspath(os.curdir))
         while current_path != previous_path:
-            ftags_path = current_path / metadata_directory_name / metadata_file_name
-            if ftags_path.is_file():
-                return current_path
+            for storage, (file_name, _) in metadata_file_names.items():
+                ftags_path = current_path / metadata_directory_name / file_name
+                if ftags_path.is_file():
+                    return current_path, storage
 
             previous_path = current_path
             current_path = current_path.parent
-        return None
+        return None, None
 
     def _get_root_dir_path(self):
         return self._root_dir
@@ -63,14 +148,89 @@ class TagEngine:
     def get_state(self):
         return self._state
 
+    def set_worker_count(self, worker_count):
+        self._worker_count = worker_count
+
     def _get_metadata_dir_path(self):
         return self._root_dir / metadata_directory_name
 
     def get_metadata_file(self):
-        return self._root_dir / metadata_directory_name / metadata_file_name
+        return self._get_metadata_dir_path() / metadata_file_names[self._storage][0]
 
     def _get_metadata_tmp_file(self):
-        return self._root_dir / metadata_directory_name / metadata_file_name_tmp
+        return self._get_metadata_dir_path() / metadata_file_names[self._storage][1]
+
+    def get_storage(self):
+        return self._storage
+
+    def migrate(self, storage):
+        if storage == self._storage:
+            raise TagEngineException(f"Database already uses {storage.value} storage")
+
+        with self._lock.hold():
+            self._migrate(storage)
+
+    def _migrate(self, storage):
+        # Fold any pending journal into the old database, so it's complete after being renamed
+        self.compact()
+        old_metadata_file = self.get_metadata_file()
+        content = self._metadata.export_content()
+        self._metadata.close()
+
+        # Write the new database under a temporary name first, so an interrupted migration never leaves
+        # a partially filled database, which would be picked up by _find_root_dir.
+        self._storage = storage
+        if storage == TagEngineStorage.Sqlite:
+            tmp_file = self._get_metadata_tmp_file()
+            tmp_file.unlink(missing_ok=True)
+            self._metadata = SqliteTagEngineMetadata(tmp_file, self._fingerprint_cache)
+            self._metadata.import_content(content)
+            self._metadata.save(self.get_metadata_file(), None)
+            tmp_file.rename(self.get_metadata_file())
+        else:
+            self._metadata = self._create_metadata(storage, None)
+            self._metadata.import_content(content)
+            self.save()
+
+        old_metadata_file.rename(old_metadata_file.with_name(f"{old_metadata_file.stem}_migrated{old_metadata_file.suffix}"))
+
+    def get_fingerprint_strategy(self):
+        return self._metadata.get_fingerprint_strategy()
+
+    def set_fingerprint_strategy(self, strategy):
+        if strategy not in fingerprint_strategies:
+            raise TagEngineException(f'Unknown fingerprint strategy "{strategy}"')
+        if strategy == self._metadata.get_fingerprint_strategy():
+            raise TagEngineException(f"Database already uses {strategy} fingerprints")
+
+        # Fingerprint every file with both strategies. Files outside of the filters are included, if they are
+        # still in the database. Old fingerprints mostly come from the cache.
+        root_dir = self._get_root_dir_path()
+        files = dict(self._get_taggable_files())
+        known_hashes = set()
+        for file_entry in self._metadata.get_files(root_dir):
+            files.setdefault(file_entry.path, None)
+            known_hashes.add(file_entry.hash)
+        old_hashes = dict(hash_files(files.items(), self._metadata.get_fingerprint_strategy(), self._fingerprint_cache, self._worker_count))
+        self._fingerprint_cache.set_strategy(strategy)
+        new_hashes = dict(hash_files(files.items(), strategy, self._fingerprint_cache, self._worker_count))
+
+        rekeyed_files = {}
+        for file_path, old_hash in old_hashes.items():
+            new_hash = new_hashes.get(file_path)
+            if old_hash in known_hashes and new_hash is not None:
+                rekeyed_files.setdefault(old_hash, []).append((new_hash, str(file_path.relative_to(root_dir))))
+
+        self._metadata.set_fingerprint_strategy(strategy, rekeyed_files)
+        self.save()
+        self.compact()
+
+        # Query symlinks are named by fingerprint
+        self.generate_all_symlinks()
+        return {
+            "num_rekeyed_files": len(rekeyed_files),
+            "num_lost_files": len(known_hashes - rekeyed_files.keys()),
+        }
 
     def get_categories(self):
         return self._metadata.get_categories()
@@ -81,82 +241,118 @@ class TagEngine:
     def save(self):
         real_file = self.get_metadata_file()
         tmp_file = self._get_metadata_tmp_file()
-        self._metadata.save(real_file, tmp_file)
-
-    def _get_taggable_files(self):
-        for root, dirs, files in os.walk(self._get_root_dir_path()):
-            for file_name in files:
-                if Path(root) == self._get_metadata_dir_path():
-                    continue
-
-                file_path = Path(os.path.abspath(os.path.join(root, file_name)))
-                if file_path.is_relative_to(self._symlinker.get_root()):
-                    continue
-
-                if not self._matches_path_filters(file_path):
-                    continue
-
-                if not self._matches_mime_filters(file_path):
-                    continue
-
-                yield file_path
-
-    def _matches_mime_filters(self, file_path):
-        mime_filters = self._metadata.get_mime_filters()
-        if len(mime_filters) == 0:
-            return True
-
-        mime_type = get_file_mime_type(file_path)
-        if mime_type is None:
+        with self._lock_metadata(), profiler.phase("metadata.save"):
+            self._merge_stored_metadata()
+            self._metadata.save(real_file, tmp_file)
+        self.save_fingerprint_cache()
+
+    def compact(self):
+        with self._lock_metadata(), profiler.phase("metadata.compact"):
+            self._merge_stored_metadata()
+            self._metadata.compact(self.get_metadata_file(), self._get_metadata_tmp_file())
+
+    def save_fingerprint_cache(self):
+        with self._lock.hold(), profiler.phase("fingerprint_cache.save"):
+            self._fingerprint_cache.save()
+
+    def _get_excluded_dirs(self):
+        # Metadata directory and the symlink tree are never taggable, so they are not even scanned
+        return [self._get_metadata_dir_path(), self._symlinker.get_root()]
+
+    def _get_taggable_files(self, start_directory=None):
+        file_filter = self._metadata.get_file_filter()
+        walked_files = walk_files(self._get_root_dir_path(), self._get_excluded_dirs(), file_filter, start_directory=start_directory)
+        for file_path, file_stat in profiler.timed_iteration("walk", walked_files):
+            yield Path(file_path), file_stat
+
+    def _is_taggable_path(self, file_path):
+        # Same checks as during the walk, but for a single file. Mime filters are checked when the file is hashed.
+        root_dir = str(self._get_root_dir_path())
+        if any(file_path == str(path) or file_path.startswith(str(path) + os.sep) for path in self._get_excluded_dirs()):
             return False
-
-        for mime_filter in mime_filters:
-            if re.match(mime_filter, mime_type):
-                return True
-        return False
-
-    def _matches_path_filters(self, file_path):
-        path_filters = self._metadata.get_path_filters()
-        if len(path_filters) == 0:
-            return True
-
-        file_path = str(file_path.absolute().relative_to(self._get_root_dir_path()))
-        for path_filter in path_filters:
-            if re.search(path_filter, str(file_path)):
-                return True
-        return False
-
-    def _setup_symlinks_for_file(self, file_path, create):
-        try:
-            file_tags = self._metadata.get_tags_for_file(file_path, None)
-        except TagEngineException as e:
-            file_tags = None
-            print(e.message)
-        if file_tags is None:
+        if not os.path.isfile(file_path):
+            return False
+        relative_path = os.path.relpath(file_path, root_dir)
+        if relative_path.startswith(os.pardir):
+            return False
+        return self._metadata.get_file_filter().matches_path(relative_path) and not is_ignored_file(root_dir, relative_path)
+
+    def _check_stored_entry(self, file_entry):
+        # Whether the file at the path stored in the metadata passes the filters. None if there's no file with
+        # the same fingerprint anymore, because it was moved or changed. Fingerprint is usually a cache hit.
+        file_path = file_entry.path.absolute()
+        if not file_path.is_file():
+            return None
+        relative_path = str(file_path.relative_to(self._get_root_dir_path()))
+        file_filter = self._metadata.get_file_filter()
+        if not file_filter.matches_path(relative_path):
+            return False
+        strategy = self._metadata.get_fingerprint_strategy()
+        if file_filter.has_mime_filters():
+            file_hash, mime_type = probe_file(file_path, strategy, self._fingerprint_cache)
+        else:
+            file_hash, mime_type = get_file_hash(file_path, strategy, self._fingerprint_cache), None
+        if file_hash != file_entry.hash:
+            return None
+        return file_filter.matches_content(relative_path, mime_type)
+
+    def _get_taggable_file_entries(self, ordered=False):
+        # Time of the walk is included, files are walked while they are hashed
+        hashed_files = hash_files(self._get_taggable_files(), self._metadata.get_fingerprint_strategy(), self._fingerprint_cache, self._worker_count, ordered, self._metadata.get_file_filter())
+        for file_path, file_hash in profiler.timed_iteration("fingerprint", hashed_files):
+            if file_hash is None:
+                continue
+            yield self._metadata.resolve_file_with_hash(file_path, file_hash)
+
+    def resolve_file(self, file_path):
+        return self._metadata.resolve_file(file_path)
+
+    def _setup_symlinks_for_file(self, file_entry, create):
+        if file_entry.tags is None:
             return
 
-        queries = (query for query in self._metadata.get_query_names() if self._metadata.matches_query(query, file_path))
-        self._symlinker.setup_symlinks_for_file(file_path, file_tags, queries, create)
+        queries = (query for query in self._metadata.get_query_names() if self._metadata.matches_query(query, file_entry))
+        self._symlinker.setup_symlinks_for_file(file_entry, queries, create)
 
     def get_untagged_files_statistics(self):
-        categories = self._metadata.get_categories()
-        taggable_files = list(self._get_taggable_files())
-        untagged_files = [f for f in taggable_files if self._metadata.is_untagged(f, categories)]
-        return {
-            "num_taggable_files": len(taggable_files),
-            "num_untagged_files": len(untagged_files),
-        }
+        statistics, _ = self.scan_untagged_files(randomize=False)
+        return statistics
 
     def get_untagged_files(self, randomize=True):
+        _, untagged_files = self.scan_untagged_files(randomize)
+        return untagged_files
+
+    def scan_untagged_files(self, randomize=True):
+        # Single walk, where every file is fingerprinted once, gives both the statistics and the files to tag.
+        # Returns the statistics and a generator of untagged files, which prepares next files in the background.
         categories = self._metadata.get_categories()
-        files = self._get_taggable_files()
+        num_taggable_files = 0
+        untagged_files = []
+        for file_entry in self._get_taggable_file_entries():
+            num_taggable_files += 1
+            if self._metadata.is_untagged(file_entry, categories):
+                untagged_files.append(file_entry)
 
         if randomize:
-            files = list(files)
-            random.shuffle(files)
+            random.shuffle(untagged_files)
 
-        files = (f for f in files if self._metadata.is_untagged(f, categories))
-        return files
+        statistics = {
+            "num_taggable_files": num_taggable_files,
+            "num_untagged_files": len(untagged_files),
+        }
+        return statistics, self._get_still_untagged_files(untagged_files)
+
+    def _get_still_untagged_files(self, file_entries):
+        # Files may be tagged in the meantime (e.g. a copy of a file tagged earlier), and categories may be added.
+        # So whether a file is untagged is checked again right before it's returned. Metadata is only accessed
+        # from this thread, the background thread does just the file I/O.
+        prefetched_files = prefetch_files((file_entry.path for file_entry in file_entries), self._metadata.get_fingerprint_strategy(), self._fingerprint_cache)
+        for file_path, file_hash in prefetched_files:
+            if file_hash is None:
+                continue
+            file_entry = self._metadata.resolve_file_with_hash(file_path, file_hash)
+            if self._metadata.is_untagged(file_entry, self._metadata.get_categories()):
+                yield file_entry
 
     def add_category(self, category):
         self._metadata.add_category(category)
@@ -170,24 +366,357 @@ class TagEngine:
     def add_query(self, query_name, rules):
         self._metadata.add_query(query_name, rules)
 
-        matching_files = (file for file in self._get_taggable_files() if self._metadata.matches_query(query_name, file))
-        self._symlinker.setup_symlinks_for_query(query_name, matching_files, True)
+        # Resolve the query through the tag index. Only the matching files have to be checked on disk, at the paths
+        # they were last seen at. Files moved or changed since are skipped and their number is returned.
+        unresolved_entries = []
+
+        def taggable_entries():
+            for entry in self._metadata.get_entries_matching_query(query_name, self._get_root_dir_path()):
+                is_taggable = self._check_stored_entry(entry)
+                if is_taggable is None:
+                    unresolved_entries.append(entry)
+                elif is_taggable:
+                    yield entry
+
+        self._symlinker.setup_symlinks_for_query(query_name, taggable_entries(), True)
+        return len(unresolved_entries)
+
+    def search(self, expression):
+        # Files matching an ad-hoc query expression. Files are taken from the metadata, so they may no longer exist.
+        return self._metadata.get_entries_matching_rules(expression, self._get_root_dir_path())
 
     def add_tag(self, category, new_tag):
         self._metadata.add_tag(category, new_tag)
 
-    def get_tags_for_file(self, file_path, category):
+    def get_tags_for_file(self, file_entry, category):
         if category is None:
             raise TagEngineException("Category must be specified")
-        return self._metadata.get_tags_for_file(file_path, category)
+        return self._metadata.get_tags_for_file(file_entry, category)
+
+    def set_tags(self, file_entry, tags):
+        self._setup_symlinks_for_file(file_entry, False)
+        self._metadata.set_tags(file_entry, tags, self._get_root_dir_path())
+        self._setup_symlinks_for_file(file_entry, True)
+
+    def import_tags(self, records):
+        # Applies a batch of (path, category, tags) records. Files are hashed in parallel and every file is
+        # updated once, no matter how many records it has. Invalid records are reported, but they don't abort
+        # the batch. Changes are not saved, the caller has to save once after the import.
+        root_dir = self._get_root_dir_path()
+        known_tags = {category: set(self.get_tags_for_category(category)) for category in self.get_categories()}
+        errors = []
+        num_records = 0
+
+        records_by_path = {}
+        for record in records:
+            num_records += 1
+            if record.error is not None:
+                errors.append((record.source, record.error))
+                continue
+            if record.category not in known_tags:
+                errors.append((record.source, f'Unknown category "{record.category}"'))
+                continue
+            unknown_tags = [tag for tag in record.tags if tag not in known_tags[record.category]]
+            if unknown_tags:
+                errors.append((record.source, f'Unknown tags in category "{record.category}": {", ".join(unknown_tags)}'))
+                continue
+            file_path = Path(os.path.abspath(record.path))
+            if not file_path.is_relative_to(root_dir):
+                errors.append((record.source, f"File {file_path} is outside of {root_dir}"))
+                continue
+            records_by_path.setdefault(file_path, []).append(record)
+
+        num_files = 0
+        hashed_files = hash_files(((file_path, None) for file_path in records_by_path), self._metadata.get_fingerprint_strategy(), self._fingerprint_cache, self._worker_count)
+        for file_path, file_hash in hashed_files:
+            path_records = records_by_path[file_path]
+            if file_hash is None:
+                errors += [(record.source, f"File {file_path} does not exist") for record in path_records]
+                continue
+
+            # Records replace tags of their category. Other categories are preserved.
+            file_entry = self._metadata.resolve_file_with_hash(file_path, file_hash)
+            tags = dict(file_entry.tags) if file_entry.tags is not None else {}
+            for record in path_records:
+                tags[record.category] = list(record.tags)
+
+            old_symlinks = self._get_symlinks_for_entry(file_entry)
+            self._metadata.set_tags(file_entry, tags, root_dir)
+            self._symlinker.update_symlinks(old_symlinks, self._get_symlinks_for_entry(file_entry))
+            num_files += 1
+
+        return {
+            "num_records": num_records,
+            "num_files": num_files,
+            "errors": errors,
+        }
 
-    def set_tags(self, file_path, tags):
-        self._setup_symlinks_for_file(file_path, False)
-        self._metadata.set_tags(file_path, tags, self._get_root_dir_path())
-        self._setup_symlinks_for_file(file_path, True)
+    def reconcile_moved_files(self, prune=False):
+        # Finds new locations of known files, which were moved or renamed. Files are matched by fingerprint.
+        # Moved files keep their inode, so their fingerprints come from the cache and they are not read again.
+        # Stored paths and symlinks of moved files are updated. Files whose content is gone are returned as
+        # orphans and removed from the database, if requested.
+        root_dir = self._get_root_dir_path()
+        found_paths = {}
+        hashed_files = hash_files(self._get_taggable_files(), self._metadata.get_fingerprint_strategy(), self._fingerprint_cache, self._worker_count, file_filter=self._metadata.get_file_filter())
+        for file_path, file_hash in hashed_files:
+            if file_hash is not None:
+                found_paths.setdefault(file_hash, []).append(file_path)
+
+        moved_files = []
+        orphaned_files = []
+        for old_entry in list(self._metadata.get_files(root_dir)):
+            paths = found_paths.get(old_entry.hash)
+            if paths is not None and old_entry.path in paths:
+                continue
+            # Walk skips files excluded by the filters or .ftagignore, so the stored path is checked on its own.
+            # The file is still there, if its stat and fingerprint (usually from the cache) match.
+            if self._is_at_stored_path(old_entry):
+                continue
+            if paths is None:
+                orphaned_files.append(old_entry)
+                continue
+
+            # Copies of a file share the entry. Pick one of them deterministically.
+            new_entry = FileEntry(min(paths), old_entry.hash, old_entry.tags)
+            self._metadata.set_file_path(new_entry, root_dir)
+            self._symlinker.update_symlinks(self._get_symlinks_for_entry(old_entry), self._get_symlinks_for_entry(new_entry))
+            moved_files.append((old_entry, new_entry))
+
+        if prune:
+            for orphaned_entry in orphaned_files:
+                self._symlinker.update_symlinks(self._get_symlinks_for_entry(orphaned_entry), {})
+                self._metadata.remove_file(orphaned_entry)
 
-    def generate_all_symlinks(self):
-        self._symlinker.cleanup()
+        return {
+            "moved_files": moved_files,
+            "orphaned_files": orphaned_files,
+        }
+
+    def _is_at_stored_path(self, file_entry):
+        file_path = file_entry.path.absolute()
+        if not file_path.is_file():
+            return False
+        return get_file_hash(file_path, self._metadata.get_fingerprint_strategy(), self._fingerprint_cache) == file_entry.hash
+
+    def find_duplicates(self, full_hash=False):
+        # Finds taggable files with the same content. Sizes are known from the walk, so only files sharing their
+        # size with another file are fingerprinted, mostly from the cache. Copies share their fingerprint and thus
+        # their entry and tags in the database. Fingerprints only cover parts of large files, so the duplicates can
+        # be confirmed by hashing the whole content, which also finds different files sharing a fingerprint.
+        # Returns (size, file entries) groups, the ones wasting the most space first.
+        files_by_size = {}
+        for file_path, file_stat in self._get_taggable_files():
+            # All empty files are the same, it's not worth reporting them
+            if file_stat.st_size > 0:
+                files_by_size.setdefault(file_stat.st_size, []).append((file_path, file_stat))
+        file_sizes = {file_path: size for size, files in files_by_size.items() if len(files) > 1 for file_path, _ in files}
+
+        paths_by_fingerprint = {}
+        candidate_files = (file for files in files_by_size.values() if len(files) > 1 for file in files)
+        hashed_files = hash_files(candidate_files, self._metadata.get_fingerprint_strategy(), self._fingerprint_cache, self._worker_count, file_filter=self._metadata.get_file_filter())
+        for file_path, file_hash in profiler.timed_iteration("fingerprint", hashed_files):
+            if file_hash is not None:
+                paths_by_fingerprint.setdefault((file_sizes[file_path], file_hash), []).append(file_path)
+        groups = [(key, paths) for key, paths in paths_by_fingerprint.items() if len(paths) > 1]
+
+        num_collisions = 0
+        if full_hash:
+            keys_by_path = {file_path: key for key, paths in groups for file_path in paths}
+            paths_by_content = {}
+            for file_path, content_hash in profiler.timed_iteration("full_hash", hash_whole_files(keys_by_path.keys(), self._worker_count)):
+                if content_hash is not None:
+                    paths_by_content.setdefault((keys_by_path[file_path], content_hash), []).append(file_path)
+            # Fingerprints shared by files with different content
+            contents_per_fingerprint = collections.Counter(key for key, _ in paths_by_content.keys())
+            num_collisions = sum(1 for count in contents_per_fingerprint.values() if count > 1)
+            groups = [(key, paths) for (key, _), paths in paths_by_content.items() if len(paths) > 1]
+
+        duplicates = []
+        for (size, file_hash), paths in groups:
+            duplicates.append((size, [self._metadata.resolve_file_with_hash(file_path, file_hash) for file_path in sorted(paths)]))
+        duplicates.sort(key=lambda group: (-group[0] * (len(group[1]) - 1), str(group[1][0].path)))
+        return {
+            "duplicates": duplicates,
+            "num_fingerprinted_files": len(file_sizes),
+            "num_collisions": num_collisions,
+        }
+
+    def _get_symlinks_for_entry(self, file_entry):
+        if file_entry.tags is None:
+            return {}
+        queries = (query for query in self._metadata.get_query_names() if self._metadata.matches_query(query, file_entry))
+        return dict(self._symlinker.get_symlinks_for_file(file_entry, queries))
+
+    def watch(self, debounce_seconds=1.0, poll_interval=None):
+        # Keeps the symlink tree up to date, until interrupted. Changes reported by the watcher are collected until
+        # they settle down. Then only the changed files are hashed and only their symlinks are updated. Yields
+        # statistics of every processed batch. Watcher is created right away, so its errors are not postponed to
+        # the first batch.
+        from engine.watcher import InotifyWatcher, PollingWatcher  # Imported only here, ctypes is slow to import
+
+        if poll_interval is None:
+            watcher = InotifyWatcher(self._get_root_dir_path(), self._get_excluded_dirs())
+        else:
+            watcher = PollingWatcher(self._get_root_dir_path(), self._get_excluded_dirs(), self._metadata.get_file_filter(), poll_interval)
+        return self._watch_changes(watcher, debounce_seconds)
 
-        for file_path in self._get_taggable_files():
-            self._setup_symlinks_for_file(file_path, True)
+    def _watch_changes(self, watcher, debounce_seconds):
+        try:
+            # Remember the state of every file, so symlinks of removed or moved files can be found later
+            entries = {str(entry.path): entry for entry in self._get_taggable_file_entries()}
+            metadata_stamp = self._get_metadata_stamp()
+            self.save_fingerprint_cache()
+
+            pending_paths = set()
+            rescan = False
+            first_change_time = None
+            while True:
+                changed_paths, events_lost = watcher.read_changes(debounce_seconds)
+                pending_paths |= changed_paths
+                rescan |= events_lost
+                if (changed_paths or events_lost) and first_change_time is None:
+                    first_change_time = time.monotonic()
+
+                # Wait until changes settle down, but don't postpone the update forever if files keep changing
+                if first_change_time is not None:
+                    settled = not changed_paths and not events_lost
+                    waiting_too_long = time.monotonic() - first_change_time > debounce_seconds * watch_max_latency_factor
+                    if settled or waiting_too_long:
+                        yield self._apply_watched_changes(entries, pending_paths, rescan)
+                        self.save_fingerprint_cache()
+                        pending_paths = set()
+                        rescan = False
+                        first_change_time = None
+
+                # Tags could have been changed by another ftag process
+                current_metadata_stamp = self._get_metadata_stamp()
+                if current_metadata_stamp != metadata_stamp:
+                    metadata_stamp = current_metadata_stamp
+                    yield self._reload_watched_metadata(entries)
+        finally:
+            watcher.close()
+
+    def _get_metadata_stamp(self):
+        stamp = []
+        for file_path in [self.get_metadata_file(), self._get_metadata_dir_path() / journal_file_name]:
+            try:
+                file_stat = os.stat(file_path)
+                stamp.append((file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append(None)
+        return stamp
+
+    def _apply_watched_changes(self, entries, changed_paths, rescan):
+        if rescan:
+            changed_paths = set(entries.keys()) | {str(file_path) for file_path, _ in self._get_taggable_files()}
+
+        # Expand directories. Files inside removed or moved directories are only known from the previous state.
+        # Files inside new directories have to be found with a walk.
+        paths_to_check = {}
+        for path in changed_paths:
+            if os.path.isdir(path) and not os.path.islink(path):
+                for file_path, file_stat in self._get_taggable_files(start_directory=path):
+                    paths_to_check[str(file_path)] = file_stat
+            else:
+                paths_to_check.setdefault(path, None)
+            directory_prefix = path + os.sep
+            for known_path in entries:
+                if known_path.startswith(directory_prefix):
+                    paths_to_check.setdefault(known_path, None)
+
+        statistics = {
+            "num_changed_paths": len(changed_paths),
+            "num_updated_files": 0,
+            "num_removed_files": 0,
+        }
+
+        # Files which are no longer taggable lose their symlinks
+        taggable_files = []
+        removed_hashes = set()
+        for path, file_stat in paths_to_check.items():
+            if self._is_taggable_path(path):
+                taggable_files.append((Path(path), file_stat))
+            elif path in entries:
+                old_entry = entries.pop(path)
+                self._symlinker.update_symlinks(self._get_symlinks_for_entry(old_entry), {})
+                removed_hashes.add(old_entry.hash)
+                statistics["num_removed_files"] += 1
+
+        # Only the changed files are hashed. Files failing mime filters are removed like the missing ones.
+        hashed_files = hash_files(taggable_files, self._metadata.get_fingerprint_strategy(), self._fingerprint_cache, self._worker_count, file_filter=self._metadata.get_file_filter())
+        for file_path, file_hash in hashed_files:
+            path = str(file_path)
+            old_entry = entries.pop(path, None)
+            if file_hash is None:
+                if old_entry is not None:
+                    self._symlinker.update_symlinks(self._get_symlinks_for_entry(old_entry), {})
+                    removed_hashes.add(old_entry.hash)
+                    statistics["num_removed_files"] += 1
+                continue
+
+            new_entry = self._metadata.resolve_file_with_hash(file_path, file_hash)
+            entries[path] = new_entry
+            if old_entry is not None and old_entry.hash == new_entry.hash and old_entry.tags == new_entry.tags:
+                continue
+            old_symlinks = self._get_symlinks_for_entry(old_entry) if old_entry is not None else {}
+            self._symlinker.update_symlinks(old_symlinks, self._get_symlinks_for_entry(new_entry))
+            if old_entry is not None:
+                removed_hashes.add(old_entry.hash)
+            statistics["num_updated_files"] += 1
+
+        # Query symlinks are named by hash, so copies of a file share them. Restore links of remaining copies.
+        if removed_hashes:
+            for entry in entries.values():
+                if entry.hash in removed_hashes:
+                    self._symlinker.update_symlinks({}, self._get_symlinks_for_entry(entry))
+
+        return statistics
+
+    def _reload_watched_metadata(self, entries):
+        self._metadata.close()
+        self._metadata = self._load_metadata()
+        if self._metadata.get_fingerprint_strategy() != self._fingerprint_cache.get_strategy():
+            # Files were rekeyed, every file has a new fingerprint
+            self._fingerprint_cache.set_strategy(self._metadata.get_fingerprint_strategy())
+            entries.clear()
+            entries.update((str(entry.path), entry) for entry in self._get_taggable_file_entries())
+
+        # No need to hash anything. Entries only have to be matched with their new tags.
+        statistics = {
+            "num_changed_paths": 0,
+            "num_updated_files": 0,
+            "num_removed_files": 0,
+        }
+        for path, old_entry in list(entries.items()):
+            new_entry = self._metadata.resolve_file_with_hash(old_entry.path, old_entry.hash)
+            entries[path] = new_entry
+            if old_entry.tags != new_entry.tags:
+                self._symlinker.update_symlinks(self._get_symlinks_for_entry(old_entry), self._get_symlinks_for_entry(new_entry))
+                statistics["num_updated_files"] += 1
+        return statistics
+
+    def _get_desired_symlinks(self):
+        # Copies of a file may want the same symlink. Files are hashed in completion order, so the smallest path
+        # is picked, otherwise the target would change from run to run.
+        desired_symlinks = {}
+        for file_entry in self._get_taggable_file_entries():
+            for symlink_path, real_file_path in self._get_symlinks_for_entry(file_entry).items():
+                current_path = desired_symlinks.get(symlink_path)
+                if current_path is None or real_file_path < current_path:
+                    desired_symlinks[symlink_path] = real_file_path
+        return desired_symlinks
+
+    def generate_all_symlinks(self, reconcile=True):
+        if reconcile:
+            with profiler.phase("symlinks.collect"):
+                desired_symlinks = self._get_desired_symlinks()
+            with profiler.phase("symlinks.reconcile"):
+                return self._symlinker.reconcile(desired_symlinks)
+
+        with profiler.phase("symlinks.cleanup"):
+            self._symlinker.cleanup()
+        with profiler.phase("symlinks.rebuild"):
+            for file_entry in self._get_taggable_file_entries():
+                self._setup_symlinks_for_file(file_entry, True)
+        return None
@@ -0,0 +1,7 @@
+class FileEntry:
+    # File resolved against the metadata. It is created once per file and passed through the engine, so the
+    # file is not hashed again for every tag and query it takes part in.
+    def __init__(self, path, file_hash, tags):
+        self.path = path
+        self.hash = file_hash
+        self.tags = tags
@@ -0,0 +1,237 @@
+import os
+
+
+def iterate_bits(bits):
+    # Yields positions of set bits. Large bitsets are scanned byte by byte, so the cost doesn't grow with the
+    # number of set bits times the size of the bitset. Small bitsets (tags of a single file) are cheaper to scan
+    # directly.
+    if bits.bit_length() <= 1024:
+        while bits:
+            lowest_bit = bits & -bits
+            yield lowest_bit.bit_length() - 1
+            bits ^= lowest_bit
+        return
+
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for byte_index, byte in enumerate(data):
+        while byte:
+            lowest_bit = byte & -byte
+            yield byte_index * 8 + lowest_bit.bit_length() - 1
+            byte ^= lowest_bit
+
+
+def _bitset_from_positions(positions, size):
+    # Bits are set as digits of a binary number, which is parsed in linear time. It's several times faster than
+    # setting bits of a bytearray one by one.
+    digits = bytearray(b"0") * size
+    for position in positions:
+        digits[position] = 49  # "1"
+    return int(digits[::-1], 2) if size > 0 else 0
+
+
+class _FileRecord:
+    # Path is kept encoded and decoded only when needed. Categories and tags are bitsets of interned ids.
+    __slots__ = ("row", "path", "category_bits", "tag_bits")
+
+    def __init__(self, row, path, category_bits, tag_bits):
+        self.row = row
+        self.path = path
+        self.category_bits = category_bits
+        self.tag_bits = tag_bits
+
+
+class FileTable:
+    # Compact storage of the files part of the metadata. Hashes are kept as binary digests, category and tag
+    # names are interned and every file stores them as two integer bitsets. Files are numbered by rows, which
+    # are used by the inverted index: every category and tag has a bitset of rows of files having it. Index is
+    # built lazily and once built, it's updated in place, only bitsets of the changed categories and tags.
+    def __init__(self):
+        self._category_ids = {}
+        self._categories = []
+        self._tag_ids = {}
+        self._tags = []
+        self._records = {}
+        self._digests = []
+        self._index = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, file_hash):
+        return bytes.fromhex(file_hash) in self._records
+
+    def _get_category_id(self, category):
+        category_id = self._category_ids.get(category)
+        if category_id is None:
+            category_id = len(self._categories)
+            self._category_ids[category] = category_id
+            self._categories.append(category)
+        return category_id
+
+    def _get_tag_id(self, category, tag):
+        key = (category, tag)
+        tag_id = self._tag_ids.get(key)
+        if tag_id is None:
+            tag_id = len(self._tags)
+            self._tag_ids[key] = tag_id
+            self._tags.append(key)
+        return tag_id
+
+    def _encode_tags(self, tags):
+        category_bits = 0
+        tag_bits = 0
+        for category, values in tags.items():
+            category_bits |= 1 << self._get_category_id(category)
+            for value in values:
+                tag_bits |= 1 << self._get_tag_id(category, value)
+        return category_bits, tag_bits
+
+    def _decode_tags(self, record):
+        tags = {self._categories[category_id]: [] for category_id in iterate_bits(record.category_bits)}
+        for tag_id in iterate_bits(record.tag_bits):
+            category, tag = self._tags[tag_id]
+            tags[category].append(tag)
+        return tags
+
+    def get_tags(self, file_hash):
+        record = self._records.get(bytes.fromhex(file_hash))
+        return self._decode_tags(record) if record is not None else None
+
+    def get_path(self, file_hash):
+        record = self._records.get(bytes.fromhex(file_hash))
+        return os.fsdecode(record.path) if record is not None else None
+
+    def set_tags(self, file_hash, path, tags):
+        # Path is used only when a new file is added
+        digest = bytes.fromhex(file_hash)
+        category_bits, tag_bits = self._encode_tags(tags)
+        record = self._records.get(digest)
+        if record is None:
+            record = self._records[digest] = _FileRecord(len(self._digests), os.fsencode(path), 0, 0)
+            self._digests.append(digest)
+        self._update_index(record.row, record.category_bits ^ category_bits, record.tag_bits ^ tag_bits)
+        record.category_bits = category_bits
+        record.tag_bits = tag_bits
+
+    def add_files(self, files):
+        # Bulk insertion of (hash, path, tags) triples, used when the metadata is loaded. Bit masks of categories
+        # and tags are looked up once per name, not once per file. Rows of every category and tag are collected on
+        # the way, so the inverted index of a table filled this way is built without decoding tags of every file.
+        records = self._records
+        digests = self._digests
+        build_index = len(records) == 0
+        category_entries = {}
+        updated_files = []
+        for file_hash, path, tags in files:
+            digest = bytes.fromhex(file_hash)
+            if digest in records:
+                # Applied once rows of the new files are in the index
+                updated_files.append((file_hash, path, tags))
+                continue
+
+            row = len(digests)
+            category_bits = 0
+            tag_bits = 0
+            for category, values in tags.items():
+                category_entry = category_entries.get(category)
+                if category_entry is None:
+                    category_entry = category_entries[category] = (1 << self._get_category_id(category), [], {})
+                category_mask, category_rows, tag_entries = category_entry
+                category_bits |= category_mask
+                category_rows.append(row)
+                for value in values:
+                    tag_entry = tag_entries.get(value)
+                    if tag_entry is None:
+                        tag_entry = tag_entries[value] = (1 << self._get_tag_id(category, value), [])
+                    tag_mask, tag_rows = tag_entry
+                    tag_bits |= tag_mask
+                    tag_rows.append(row)
+            records[digest] = _FileRecord(row, os.fsencode(path), category_bits, tag_bits)
+            digests.append(digest)
+
+        if build_index:
+            self._index = {(category, None): 0 for category in self._categories}
+            self._index.update((key, 0) for key in self._tags)
+        if self._index is not None:
+            num_rows = len(digests)
+            for category, (_, category_rows, tag_entries) in category_entries.items():
+                key = (category, None)
+                self._index[key] = self._index.get(key, 0) | _bitset_from_positions(category_rows, num_rows)
+                for value, (_, tag_rows) in tag_entries.items():
+                    key = (category, value)
+                    self._index[key] = self._index.get(key, 0) | _bitset_from_positions(tag_rows, num_rows)
+        for file_hash, path, tags in updated_files:
+            self.set_tags(file_hash, path, tags)
+
+    def set_path(self, file_hash, path):
+        record = self._records.get(bytes.fromhex(file_hash))
+        if record is not None:
+            record.path = os.fsencode(path)
+
+    def remove(self, file_hash):
+        record = self._records.pop(bytes.fromhex(file_hash), None)
+        if record is not None:
+            self._digests[record.row] = None
+            self._update_index(record.row, record.category_bits, record.tag_bits)
+
+    def _update_index(self, row, changed_category_bits, changed_tag_bits):
+        # Flips the row in bitsets of categories and tags, which the file gained or lost
+        if self._index is None:
+            return
+        row_bit = 1 << row
+        for category_id in iterate_bits(changed_category_bits):
+            key = (self._categories[category_id], None)
+            self._index[key] = self._index.get(key, 0) ^ row_bit
+        for tag_id in iterate_bits(changed_tag_bits):
+            key = self._tags[tag_id]
+            self._index[key] = self._index.get(key, 0) ^ row_bit
+
+    def items(self, first_bytes=None):
+        # Yields (hash, path, tags) of every file. Files can be limited to hashes starting with given bytes.
+        for digest, record in self._records.items():
+            if first_bytes is not None and digest[0] not in first_bytes:
+                continue
+            yield digest.hex(), os.fsdecode(record.path), self._decode_tags(record)
+
+    def _get_index(self):
+        if self._index is None:
+            # Files often share the same combination of tags, so every combination is decoded only once
+            rows_by_category_bits = {}
+            rows_by_tag_bits = {}
+            for record in self._records.values():
+                rows_by_category_bits.setdefault(record.category_bits, []).append(record.row)
+                rows_by_tag_bits.setdefault(record.tag_bits, []).append(record.row)
+
+            category_rows = [[] for _ in self._categories]
+            for category_bits, rows in rows_by_category_bits.items():
+                for category_id in iterate_bits(category_bits):
+                    category_rows[category_id] += rows
+            tag_rows = [[] for _ in self._tags]
+            for tag_bits, rows in rows_by_tag_bits.items():
+                for tag_id in iterate_bits(tag_bits):
+                    tag_rows[tag_id] += rows
+
+            num_rows = len(self._digests)
+            self._index = {}
+            for category, rows in zip(self._categories, category_rows):
+                self._index[(category, None)] = _bitset_from_positions(rows, num_rows)
+            for key, rows in zip(self._tags, tag_rows):
+                self._index[key] = _bitset_from_positions(rows, num_rows)
+        return self._index
+
+    def get_keys(self):
+        return self._get_index().keys()
+
+    def get_bitset(self, key):
+        # Rows of files having the (category, tag) key. Tag None means files having the category assigned.
+        return self._get_index().get(key, 0)
+
+    def get_tagged_bitset(self):
+        # Rows of files having at least one category assigned
+        bits = 0
+        for category in self._categories:
+            bits |= self.get_bitset((category, None))
+        return bits
+
+    def get_hashes(self, bits):
+        return [self._digests[row].hex() for row in iterate_bits(bits)]
@@ -0,0 +1,107 @@
+import os
+import re
+
+from engine.misc import combine_mime_types, guess_mime_type
+from engine.profiler import profiler
+
+
+def _has_group_number_reference(pattern):
+    # Backreferences (\1) and conditionals ((?(1)...)) by group number. Escaped backslashes are dropped first,
+    # so an escaped backslash followed by a digit is not taken for one.
+    return re.search(r"\\[1-9]|\(\?\(\d", pattern.replace("\\\\", "")) is not None
+
+
+def _compile_any(patterns):
+    # Combine all patterns into one alternation, so a single regex call checks all of them. Patterns which
+    # cannot be combined (e.g. because of global inline flags, or group numbers shifted by groups of preceding
+    # patterns) are kept as separate regexes.
+    if len(patterns) == 0:
+        return []
+    if any(_has_group_number_reference(pattern) for pattern in patterns):
+        return [re.compile(pattern) for pattern in patterns]
+    try:
+        return [re.compile("|".join(f"(?:{pattern})" for pattern in patterns))]
+    except re.error:
+        return [re.compile(pattern) for pattern in patterns]
+
+
+def _get_anchored_prefix(pattern):
+    # Returns a literal prefix, which every path matched by the pattern must start with. Only simple patterns
+    # anchored with "^" are understood. None means any path can match.
+    if not pattern.startswith("^") or "|" in pattern:
+        return None
+
+    prefix = ""
+    index = 1
+    while index < len(pattern):
+        character = pattern[index]
+        if character == "\\" and index + 1 < len(pattern) and not pattern[index + 1].isalnum():
+            prefix += pattern[index + 1]
+            index += 2
+        elif character in ".^$*+?{}[]\\|()":
+            # The last literal character is optional, if it's followed by a quantifier
+            if character in "*?{" and prefix:
+                prefix = prefix[:-1]
+            break
+        else:
+            prefix += character
+            index += 1
+    return prefix if prefix else None
+
+
+class FileFilter:
+    # Compiled form of path and mime filters stored in the metadata. In case of multiple filters of given
+    # type, at least one must be satisfied.
+    def __init__(self, path_filters, mime_filters):
+        self._path_regexes = _compile_any(path_filters)
+        self._path_prefixes = [_get_anchored_prefix(pattern) for pattern in path_filters]
+        self._mime_regexes = _compile_any(mime_filters)
+        self._mime_types_by_extension = {}
+        self._mime_matches_by_type = {}
+
+    def matches(self, relative_path):
+        # Path filters are cheap, so run them first. Mime filters are only checked for files which passed.
+        return self.matches_path(relative_path) and self.matches_mime(relative_path)
+
+    def has_mime_filters(self):
+        return len(self._mime_regexes) > 0
+
+    def matches_path(self, relative_path):
+        if not self._path_regexes:
+            return True
+        return any(regex.search(relative_path) for regex in self._path_regexes)
+
+    def may_match_directory(self, relative_directory):
+        # Checks, whether any file inside the directory can pass path filters. Used to skip whole directories.
+        if not self._path_prefixes or None in self._path_prefixes:
+            return True
+        relative_directory += os.sep
+        return any(prefix.startswith(relative_directory) or relative_directory.startswith(prefix) for prefix in self._path_prefixes)
+
+    def matches_mime(self, relative_path):
+        # Only the extension is used, the file is not read
+        if not self._mime_regexes:
+            return True
+        return self._matches_mime_type(self._guess_mime_type(relative_path))
+
+    def matches_content(self, relative_path, content_mime_type):
+        # Mime filters checked against the type sniffed from the content of the file
+        if not self._mime_regexes:
+            return True
+        return self._matches_mime_type(combine_mime_types(content_mime_type, self._guess_mime_type(relative_path)))
+
+    def _guess_mime_type(self, relative_path):
+        # Extension consists of at most two suffixes (e.g. ".tar.gz"), so the guess can be memoized per extension
+        stem, last_suffix = os.path.splitext(os.path.basename(relative_path))
+        extension = os.path.splitext(stem)[1] + last_suffix
+        if extension not in self._mime_types_by_extension:
+            profiler.count("mime_lookups")
+            self._mime_types_by_extension[extension] = guess_mime_type(f"file{extension}")
+        return self._mime_types_by_extension[extension]
+
+    def _matches_mime_type(self, mime_type):
+        result = self._mime_matches_by_type.get(mime_type)
+        if result is None:
+            result = mime_type is not None and any(regex.match(mime_type) for regex in self._mime_regexes)
+            self._mime_matches_by_type[mime_type] = result
+        return result
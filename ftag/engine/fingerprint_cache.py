@@ -0,0 +1,125 @@
+import json
+import shutil
+import threading
+
+from engine.misc import head_fingerprint_strategy
+from engine.profiler import profiler
+
+default_max_entries = 500000
+
+
+class FingerprintCache:
+    def __init__(self, cache_file_path, tmp_file_path, max_entries=default_max_entries):
+        self._strategy = head_fingerprint_strategy
+        self._cache_file_path = cache_file_path
+        self._tmp_file_path = tmp_file_path
+        self._max_entries = max_entries
+        self._dirty = False
+        self._lock = threading.Lock()  # Files may be hashed from multiple threads
+        self._entries = None
+        self._generation = 0
+
+    def _get_entries(self):
+        # Cache is loaded once it's used, commands which don't hash any files don't pay for it. Lock must be held.
+        if self._entries is None:
+            with profiler.phase("fingerprint_cache.load"):
+                self._load()
+        return self._entries
+
+    def _load(self):
+        # Entries are keyed by device and inode. Size and mtime are stored alongside the hash and are used to
+        # detect stale entries. Every load starts a new generation, which is used for least-recently-used eviction.
+        self._entries = {}
+        self._generation = 0
+        if self._cache_file_path is None or not self._cache_file_path.is_file():
+            return
+
+        try:
+            with open(self._cache_file_path, "r") as file:
+                content = json.load(file)
+            self._generation = content["generation"] + 1
+            self._entries = content["entries"]
+            if content.get("strategy", head_fingerprint_strategy) != self._strategy:
+                # Fingerprints of a different strategy are useless
+                self._entries = {}
+                self._dirty = True
+        except (OSError, ValueError, KeyError):
+            # Cache is only an optimization. If it's broken, just start from scratch.
+            self._entries = {}
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or self._cache_file_path is None:
+                return
+
+            self._evict()
+            self._cache_file_path.parent.mkdir(exist_ok=True, parents=False)
+            with open(self._tmp_file_path, "w") as file:
+                json.dump({"generation": self._generation, "strategy": self._strategy, "entries": self._entries}, file)
+            shutil.move(self._tmp_file_path, self._cache_file_path)
+            self._dirty = False
+
+    def get_strategy(self):
+        return self._strategy
+
+    def set_strategy(self, strategy):
+        # Fingerprints of a different strategy are useless
+        with self._lock:
+            if strategy != self._strategy:
+                self._strategy = strategy
+                if self._entries is not None:
+                    self._entries = {}
+                    self._dirty = True
+
+    def _evict(self):
+        if len(self._entries) <= self._max_entries:
+            return
+
+        # Keep the most recently used entries
+        keys = sorted(self._entries.keys(), key=lambda key: self._entries[key][3], reverse=True)
+        for key in keys[self._max_entries :]:
+            del self._entries[key]
+
+    @staticmethod
+    def _get_key(file_stat):
+        return f"{file_stat.st_dev}:{file_stat.st_ino}"
+
+    def _get_entry(self, file_stat):
+        # Lock must be held
+        key = FingerprintCache._get_key(file_stat)
+        entry = self._get_entries().get(key)
+        if entry is None:
+            return None
+
+        size, mtime_ns, _, generation = entry[:4]
+        if size != file_stat.st_size or mtime_ns != file_stat.st_mtime_ns:
+            # The file has changed since it was hashed, or the inode was reused by another file.
+            del self._entries[key]
+            self._dirty = True
+            return None
+
+        if generation != self._generation:
+            entry[3] = self._generation
+            self._dirty = True
+        return entry
+
+    def get(self, file_stat):
+        with self._lock:
+            entry = self._get_entry(file_stat)
+            return entry[2] if entry is not None else None
+
+    def get_probe(self, file_stat):
+        # Fingerprint and the sniffed mime type. Entries written before mime types were sniffed don't have it,
+        # they are treated as missing.
+        with self._lock:
+            entry = self._get_entry(file_stat)
+            if entry is None or len(entry) < 5:
+                return None
+            return entry[2], entry[4]
+
+    def put(self, file_stat, file_hash, mime_type):
+        key = FingerprintCache._get_key(file_stat)
+        with self._lock:
+            self._get_entries()[key] = [file_stat.st_size, file_stat.st_mtime_ns, file_hash, self._generation, mime_type]
+            self._dirty = True
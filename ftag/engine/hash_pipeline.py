@@ -0,0 +1,88 @@
+import collections
+import itertools
+
+from engine.misc import get_file_hash, get_full_file_hash, prefetch_file, probe_file
+
+default_worker_count = 8
+queue_depth_per_worker = 4
+default_prefetch_depth = 3
+
+
+def hash_files(files, strategy, fingerprint_cache, worker_count=default_worker_count, ordered=False, file_filter=None):
+    # Takes (path, stat) pairs, where stat can be None, and yields (path, hash) pairs. Hash is None for files
+    # that disappeared in the meantime. If a filter is given, its mime filters are checked against the content
+    # read for the fingerprint, and files which don't pass get None too.
+    if file_filter is not None and not file_filter.has_mime_filters():
+        file_filter = None
+    return _map_files(lambda file: _hash_file(file[0], file[1], strategy, fingerprint_cache, file_filter), files, worker_count, ordered)
+
+
+def hash_whole_files(file_paths, worker_count=default_worker_count):
+    # Like hash_files, but the whole content of the files is hashed
+    return _map_files(lambda file_path: (file_path, get_full_file_hash(file_path)), file_paths, worker_count, False)
+
+
+def _map_files(function, files, worker_count, ordered):
+    # Runs the function on a thread pool while the files are still being produced, so the I/O latency of many
+    # files overlaps. The number of files in flight is bounded, so a huge directory walk is never buffered entirely.
+    if worker_count <= 1:
+        for file in files:
+            yield function(file)
+        return
+
+    import concurrent.futures  # Imported only when files are hashed, it's slow to import
+
+    max_in_flight = worker_count * queue_depth_per_worker
+    files = iter(files)
+
+    def submit(executor, count):
+        return [executor.submit(function, file) for file in itertools.islice(files, count)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+        if ordered:
+            pending = collections.deque(submit(executor, max_in_flight))
+            while pending:
+                yield pending.popleft().result()
+                pending.extend(submit(executor, 1))
+        else:
+            pending = set(submit(executor, max_in_flight))
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                pending.update(submit(executor, len(done)))
+
+
+def prefetch_files(file_paths, strategy, fingerprint_cache, depth=default_prefetch_depth):
+    # Prepares the next few files on a background thread while the caller works on the current one. A file is
+    # hashed again, in case it changed since it was listed (usually a cache hit), and read ahead into the OS cache.
+    # Yields (path, hash) pairs in the original order, hash is None for files that disappeared.
+    import concurrent.futures  # Imported only when files are hashed, it's slow to import
+
+    file_paths = iter(file_paths)
+
+    def submit(executor, count):
+        return [executor.submit(_prefetch_file, file_path, strategy, fingerprint_cache) for file_path in itertools.islice(file_paths, count)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = collections.deque(submit(executor, depth))
+        while pending:
+            result = pending.popleft().result()
+            pending.extend(submit(executor, 1))
+            yield result
+
+
+def _prefetch_file(file_path, strategy, fingerprint_cache):
+    file_hash = get_file_hash(file_path, strategy, fingerprint_cache)
+    if file_hash is not None:
+        prefetch_file(file_path)
+    return file_path, file_hash
+
+
+def _hash_file(file_path, file_stat, strategy, fingerprint_cache, file_filter):
+    if file_filter is None:
+        return file_path, get_file_hash(file_path, strategy, fingerprint_cache, file_stat)
+    file_hash, mime_type = probe_file(file_path, strategy, fingerprint_cache, file_stat)
+    if file_hash is not None and not file_filter.matches_content(str(file_path), mime_type):
+        return file_path, None
+    return file_path, file_hash
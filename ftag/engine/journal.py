@@ -0,0 +1,63 @@
+import json
+import os
+
+from engine.exception import TagEngineException
+
+
+class MetadataJournal:
+    # Append-only log of metadata changes stored next to the snapshot. Each line holds all records written by
+    # a single save, together with the version it produced. A line is written with one write call and synced,
+    # so after a crash the journal contains either the whole save or a torn last line without a newline. Torn line
+    # is ignored and cut off before the next append, so any other line which can't be read means corrupt journal.
+    def __init__(self, journal_file_path):
+        self._journal_file_path = journal_file_path
+        self._entry_count = 0
+
+    def get_entry_count(self):
+        return self._entry_count
+
+    def read(self, snapshot_version):
+        # Yields (version, records) of entries, which are newer than the snapshot
+        self._entry_count = 0
+        if not self._journal_file_path.is_file():
+            return
+
+        with open(self._journal_file_path, "rb") as file:
+            content = file.read()
+
+        # Last item is empty, unless the last line is torn
+        lines = content.split(b"\n")[:-1]
+        for line_number, line in enumerate(lines, 1):
+            try:
+                entry = json.loads(line)
+                version, records = entry["version"], entry["records"]
+            except (ValueError, TypeError, KeyError):
+                raise TagEngineException(f"Metadata seems to be incorrect. Line {line_number} of journal {self._journal_file_path} is corrupt.")
+            self._entry_count += 1
+            if version > snapshot_version:
+                yield version, records
+
+    def append(self, version, records):
+        line = json.dumps({"version": version, "records": records}) + "\n"
+
+        with open(self._journal_file_path, "ab+") as file:
+            MetadataJournal._truncate_torn_line(file)
+            file.write(line.encode())
+            file.flush()
+            os.fsync(file.fileno())
+        self._entry_count += 1
+
+    @staticmethod
+    def _truncate_torn_line(file):
+        size = file.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        file.seek(size - 1)
+        if file.read(1) == b"\n":
+            return
+        file.seek(0)
+        file.truncate(file.read().rfind(b"\n") + 1)
+
+    def remove(self):
+        self._journal_file_path.unlink(missing_ok=True)
+        self._entry_count = 0
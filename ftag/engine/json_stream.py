@@ -0,0 +1,82 @@
+import codecs
+import json
+import re
+
+read_size = 64 * 1024
+whitespace_regex = re.compile(r"[ \t\n\r]*")
+
+
+class JsonStreamReader:
+    # Reads a JSON document from a binary file piece by piece, so members of a large object can be decoded one
+    # at a time, or the rest of the document can be left unread. Only the unconsumed part is kept in memory.
+    def __init__(self, file):
+        self._file = file
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._text = ""
+        self._position = 0
+        self._consumed_bytes = 0
+        self._eof = False
+
+    def _read_more(self):
+        if self._eof:
+            raise ValueError("Unexpected end of JSON document")
+
+        # Consumed text is dropped, its size in bytes is still tracked for get_offset
+        consumed = self._text[: self._position]
+        self._consumed_bytes += len(consumed.encode("utf-8"))
+        chunk = self._file.read(read_size)
+        self._eof = len(chunk) < read_size
+        self._text = self._text[self._position :] + self._text_decoder.decode(chunk, final=self._eof)
+        self._position = 0
+
+    def get_offset(self):
+        # Byte offset of the next unconsumed character in the file
+        return self._consumed_bytes + len(self._text[: self._position].encode("utf-8"))
+
+    def peek(self):
+        while True:
+            self._position = whitespace_regex.match(self._text, self._position).end()
+            if self._position < len(self._text):
+                return self._text[self._position]
+            self._read_more()
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError(f'Expected "{character}" at offset {self.get_offset()}')
+        self._position += 1
+
+    def skip(self, character):
+        # Consumes the character if it's next
+        if self.peek() != character:
+            return False
+        self._position += 1
+        return True
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._text, self._position)
+            except json.JSONDecodeError:
+                self._read_more()
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._text) and not self._eof:
+                self._read_more()
+                continue
+            self._position = end
+            return value
+
+    def iterate_object(self):
+        # Yields (key, value) members of an object
+        self.expect("{")
+        if self.skip("}"):
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            yield key, self.decode_value()
+            if self.skip("}"):
+                return
+            self.expect(",")
@@ -0,0 +1,49 @@
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows. Processes are not synchronized there.
+    fcntl = None
+
+
+class MetadataLock:
+    # Advisory lock of the metadata directory, shared by all ftag processes working on the same root. Writers hold
+    # it exclusively while they save, readers shared while they load, so nobody reads a snapshot and a journal
+    # belonging to different versions. The lock can be held repeatedly by the same engine, only the outermost
+    # hold locks the file.
+    def __init__(self, lock_file_path):
+        self._lock_file_path = lock_file_path
+        self._file = None
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def hold(self, exclusive=True):
+        if self._depth == 0:
+            self._acquire(exclusive)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self._release()
+
+    def _acquire(self, exclusive):
+        if fcntl is None:
+            return
+        try:
+            self._lock_file_path.parent.mkdir(exist_ok=True, parents=False)
+            self._file = open(self._lock_file_path, "a")
+        except OSError:
+            # Read-only metadata directory. Nobody can write there, so there is nothing to synchronize with.
+            self._file = None
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def _release(self):
+        if self._file is None:
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
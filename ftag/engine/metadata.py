@@ -1,16 +1,60 @@
 import json
+import os
 import re
 import shutil
 
 from engine.exception import TagEngineException
-from engine.misc import get_file_hash
+from engine.file_entry import FileEntry
+from engine.file_table import FileTable
+from engine.filters import FileFilter
+from engine.journal import MetadataJournal
+from engine.json_stream import JsonStreamReader
+from engine.misc import get_file_hash, head_fingerprint_strategy, sampled_fingerprint_strategy
+from engine.profiler import profiler
+from engine.query import compile_query
 
 name_regex = "^[A-Za-z][A-Za-z_0-9]*$"
 backup_version_interval = 5
+journal_file_name = "journal.jsonl"
+journal_compaction_threshold = 100
+required_sections = ["filters", "files", "tags", "version", "queries"]
+file_operations = ["set_tags", "set_path", "remove_file", "set_fingerprint"]
+
+
+def merge_tags(base_tags, our_tags, their_tags):
+    # Three-way merge of tags of a single file, None stands for an untagged file. Categories are merged one by one.
+    # If only one side changed a category, its tags are taken. If both did, tags added by either side are kept and
+    # tags removed by either side are removed.
+    base_tags, our_tags, their_tags = base_tags or {}, our_tags or {}, their_tags or {}
+    merged_tags = {}
+    for category in list(their_tags) + [c for c in our_tags if c not in their_tags]:
+        base, ours, theirs = base_tags.get(category), our_tags.get(category), their_tags.get(category)
+        if ours == base:
+            value = theirs
+        elif theirs == base or theirs == ours:
+            value = ours
+        else:
+            removed_by_us = set(base or []) - set(ours or [])
+            removed_by_them = set(base or []) - set(theirs or [])
+            value = [tag for tag in theirs or [] if tag not in removed_by_us]
+            value += [tag for tag in ours or [] if tag not in removed_by_them and tag not in value]
+        if value is not None:
+            merged_tags[category] = value
+    return merged_tags
 
 
 class TagEngineMetadata:
-    def __init__(self, metadata_file_path):
+    def __init__(self, metadata_file_path, fingerprint_cache=None):
+        self._fingerprint_cache = fingerprint_cache
+        self._file_filter = None
+        self._journal = None
+        self._pending_records = []
+        self._base_tags = {}
+        self._snapshot_version = None
+        self._file_table = None
+        self._file_loader = None
+        self._deferred_records = []
+        self._snapshot_file = None
         if metadata_file_path is not None:
             self.load(metadata_file_path)
         else:
@@ -18,7 +62,6 @@ class TagEngineMetadata:
 
     def load_empty(self):
         self._metadata = {
-            "files": {},
             "filters": {
                 "mime": [],
                 "path": [],
@@ -26,44 +69,262 @@ class TagEngineMetadata:
             "tags": {},
             "version": 0,
             "queries": {},
+            "fingerprint": sampled_fingerprint_strategy,
         }
+        self._snapshot_version = None
+        self._files = FileTable()
+
+    @property
+    def _files(self):
+        # Files are the bulk of the metadata. They are loaded only once some operation needs them, so commands
+        # which change just the configuration start fast even with a large database.
+        if self._file_table is None:
+            self._load_files()
+        return self._file_table
+
+    @_files.setter
+    def _files(self, files):
+        self._file_table = files
+        self._file_loader = None
+        self._deferred_records = []
+
+    def _defer_file_loading(self, file_loader):
+        # Loader fills the given file table. Journal records changing files are kept until then.
+        self._file_table = None
+        self._file_loader = file_loader
+        self._deferred_records = []
+
+    def close(self):
+        # Releases the snapshot kept open for loading files lazily. Metadata must not be used afterwards.
+        if self._snapshot_file is not None:
+            self._snapshot_file.close()
+        self._file_loader = None
+
+    def _load_files(self):
+        file_loader, deferred_records = self._file_loader, self._deferred_records
+        self._files = FileTable()
+        with profiler.phase("metadata.files_load"):
+            if file_loader is not None:
+                file_loader(self._file_table)
+            for record in deferred_records:
+                self._apply_file_record(record)
 
     def load(self, metadata_file_path):
-        with open(metadata_file_path, "r") as file:
-            self._metadata = json.load(file)
-
+        with profiler.phase("metadata.snapshot_load"):
+            self._load_snapshot(metadata_file_path)
+        self._snapshot_version = self._metadata["version"]
+
+        # Replay changes saved after the snapshot was written
+        self._journal = MetadataJournal(metadata_file_path.parent / journal_file_name)
+        with profiler.phase("metadata.journal_replay"):
+            for version, records in self._journal.read(self._snapshot_version):
+                for record in records:
+                    self._apply_record(record)
+                profiler.count("journal_records_replayed", len(records))
+                self._metadata["version"] = version
+
+    def _load_snapshot(self, metadata_file_path):
+        # Snapshot is parsed up to the files section. It's written as the last one, so the files are left for later
+        # and the file stays open, in case it's replaced meanwhile. Older snapshots with files first are parsed whole.
+        snapshot_file = open(metadata_file_path, "rb")
+        try:
+            reader = JsonStreamReader(snapshot_file)
+            sections = {}
+            reader.expect("{")
+            while not reader.skip("}"):
+                reader.skip(",")
+                section = reader.decode_value()
+                reader.expect(":")
+                if section == "files" and all(s in sections for s in required_sections if s != "files"):
+                    break
+                elif section == "files":
+                    snapshot_file.seek(0)
+                    self.import_content(json.load(snapshot_file))
+                    snapshot_file.close()
+                    return
+                sections[section] = reader.decode_value()
+            else:
+                # No files section, validation will fail
+                snapshot_file.close()
+                self.import_content(sections)
+                return
+        except BaseException:
+            snapshot_file.close()
+            raise
+
+        sections["files"] = {}
+        self.import_content(sections)
+        self._snapshot_file = snapshot_file
+        self._defer_file_loading(lambda files: TagEngineMetadata._read_snapshot_files(snapshot_file, reader, files))
+
+    @staticmethod
+    def _read_snapshot_files(snapshot_file, reader, files):
+        with snapshot_file:
+            files.add_files((file_hash, file_metadata["path"], file_metadata["tags"]) for file_hash, file_metadata in reader.iterate_object())
+            if not reader.skip("}"):
+                raise TagEngineException('Metadata seems to be incorrect. Section "files" is not the last one.')
+
+    def import_content(self, content):
+        TagEngineMetadata._validate_content(content)
+        self._metadata = {key: value for key, value in content.items() if key != "files"}
+        self._snapshot_version = None
+        self._clear_pending_records()
+        self._file_filter = None
+
+        # Files are the bulk of the metadata. They are kept in a compact form instead of nested dicts.
+        self._files = FileTable()
+        self._files.add_files((file_hash, file_metadata["path"], file_metadata["tags"]) for file_hash, file_metadata in content["files"].items())
+
+    @staticmethod
+    def _validate_content(content):
         def require_field(field):
-            if field not in self._metadata:
+            if field not in content:
                 raise TagEngineException(f'Metadata seems to be incorrect. Field "{field}" does not exist.')
 
         # Simple basic validation
-        require_field("filters")
-        require_field("files")
-        require_field("tags")
-        require_field("version")
-        require_field("queries")
+        for field in required_sections:
+            require_field(field)
 
     def save(self, metadata_file_path, tmp_file):
         self._metadata["version"] += 1
+        if self._journal is None:
+            self._journal = MetadataJournal(metadata_file_path.parent / journal_file_name)
 
-        metadata_file_path.parent.mkdir(exist_ok=True, parents=False)
-        with open(tmp_file, "w") as file:
-            content = json.dump(self._metadata, file, indent=4)
-        shutil.move(tmp_file, metadata_file_path)
+        # Changes are appended to the journal. Whole database is written only if there is no snapshot yet or
+        # the journal grew long enough.
+        if self._snapshot_version is None or self._journal.get_entry_count() + 1 >= journal_compaction_threshold:
+            self.compact(metadata_file_path, tmp_file)
+        else:
+            self._journal.append(self._metadata["version"], self._pending_records)
+            profiler.count("journal_records_written", len(self._pending_records))
+            self._clear_pending_records()
 
-        if self._metadata["version"] % backup_version_interval == 0:
+    def compact(self, metadata_file_path, tmp_file):
+        metadata_file_path.parent.mkdir(exist_ok=True, parents=False)
+        with profiler.phase("metadata.snapshot_write"):
+            with open(tmp_file, "w") as file:
+                json.dump(self.export_content(), file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            shutil.move(tmp_file, metadata_file_path)
+
+        # Snapshot contains everything now. If we crash before removing the journal, its entries are older than
+        # the snapshot and will be skipped during load.
+        previous_snapshot_version = self._snapshot_version or 0
+        self._snapshot_version = self._metadata["version"]
+        self._clear_pending_records()
+        if self._journal is None:
+            self._journal = MetadataJournal(metadata_file_path.parent / journal_file_name)
+        self._journal.remove()
+
+        if self._snapshot_version // backup_version_interval > previous_snapshot_version // backup_version_interval:
             backup_version = str(self._metadata["version"]).zfill(4)
             backup_file_name = f"{metadata_file_path.stem}_v{backup_version}{metadata_file_path.suffix}"
             backup_file_path = metadata_file_path.parent / backup_file_name
             shutil.copy(metadata_file_path, backup_file_path)
 
-    def is_untagged(self, file_path, categories):
-        file_hash = get_file_hash(file_path)
-        if file_hash not in self._metadata["files"]:
-            return True
+    def _record(self, record):
+        self._apply_record(record)
+        self._pending_records.append(record)
+
+    def _clear_pending_records(self):
+        self._pending_records = []
+        self._base_tags = {}
+
+    def merge_into(self, stored_metadata):
+        # Replays changes, which were not saved yet, onto metadata saved meanwhile by another process. Tags are
+        # merged file by file, with the tags a file had before the first unsaved change as the common base. Other
+        # changes are additive or idempotent, so they are replayed as they are. Every set_tags record replaces tags
+        # of the file, so only the last one per file is merged, otherwise the earlier ones would become their side.
+        last_set_tags = {record["hash"]: index for index, record in enumerate(self._pending_records) if record["operation"] == "set_tags"}
+        for index, record in enumerate(self._pending_records):
+            if record["operation"] == "set_tags":
+                if last_set_tags[record["hash"]] != index:
+                    continue
+                their_tags = stored_metadata._files.get_tags(record["hash"])
+                record = dict(record, tags=merge_tags(self._base_tags.get(record["hash"]), record["tags"], their_tags))
+            stored_metadata._record(record)
+        return stored_metadata
+
+    def _apply_record(self, record):
+        # Records must be idempotent, because they are replayed from the journal. Validation is done before
+        # a record is created, so it's not repeated here.
+        operation = record["operation"]
+        if operation == "add_category":
+            self._metadata["tags"].setdefault(record["category"], [])
+        elif operation == "add_tag":
+            tags = self._metadata["tags"].setdefault(record["category"], [])
+            if record["tag"] not in tags:
+                tags.append(record["tag"])
+        elif operation == "add_filter":
+            filters = self._metadata["filters"][record["kind"]]
+            if record["filter"] not in filters:
+                filters.append(record["filter"])
+                self._file_filter = None
+        elif operation == "add_query":
+            self._metadata["queries"][record["query"]] = record["rules"]
+        elif operation in file_operations:
+            if operation == "set_fingerprint":
+                self._metadata["fingerprint"] = record["strategy"]
+            if self._file_table is None:
+                self._deferred_records.append(record)
+            else:
+                self._apply_file_record(record)
+        else:
+            raise TagEngineException(f'Unknown metadata journal operation "{operation}"', developer_error=True)
+
+    def _apply_file_record(self, record):
+        operation = record["operation"]
+        if operation == "set_tags":
+            # Create new entry, if file is not in the database. Only tags can be changed. Rest of the metadata
+            # is constant. Hash is unique identifier. Path is only for sanity checks, but it's not used.
+            self._files.set_tags(record["hash"], record["path"], record["tags"])
+        elif operation == "set_path":
+            self._files.set_path(record["hash"], record["path"])
+        elif operation == "remove_file":
+            self._files.remove(record["hash"])
+        elif operation == "set_fingerprint":
+            # Files are keyed by fingerprint, so every file gets a new key. Files, which were not found during
+            # the rekeying, keep their old keys. Copies sharing the old key get their own entries.
+            files = FileTable()
+            for file_hash, path, tags in self._files.items():
+                if file_hash not in record["files"]:
+                    files.set_tags(file_hash, path, tags)
+                    continue
+                for new_file_hash, new_path in record["files"][file_hash]:
+                    files.set_tags(new_file_hash, new_path, tags)
+            self._files = files
+
+    def get_version(self):
+        return self._metadata["version"]
+
+    def get_fingerprint_strategy(self):
+        # Databases created before fingerprint strategies were introduced use the head of the file
+        return self._metadata.get("fingerprint", head_fingerprint_strategy)
+
+    def export_content(self):
+        content = dict(self._metadata)
+        content["files"] = {file_hash: {"path": path, "tags": tags} for file_hash, path, tags in self._files.items()}
+        return content
+
+    def resolve_file(self, file_path):
+        file_hash = get_file_hash(file_path, self.get_fingerprint_strategy(), self._fingerprint_cache)
+        if file_hash is None:
+            raise TagEngineException(f"File {file_path} does not exist")
+        return self.resolve_file_with_hash(file_path, file_hash)
+
+    def resolve_file_with_hash(self, file_path, file_hash):
+        return FileEntry(file_path, file_hash, self._files.get_tags(file_hash))
 
-        file_tags = list(self._metadata["files"][file_hash]["tags"].keys())
-        return any((c not in file_tags for c in categories))
+    def get_files(self, root_dir_path):
+        # All known files with the paths they were last seen at
+        for file_hash, path, tags in self._files.items():
+            yield FileEntry(root_dir_path / path, file_hash, tags)
+
+    def is_untagged(self, file_entry, categories):
+        if file_entry.tags is None:
+            return True
+        return any((c not in file_entry.tags for c in categories))
 
     def get_mime_filters(self):
         return self._metadata["filters"]["mime"]
@@ -71,24 +332,31 @@ class TagEngineMetadata:
     def get_path_filters(self):
         return self._metadata["filters"]["path"]
 
+    def get_file_filter(self):
+        # Filters are compiled once and reused for every file
+        if self._file_filter is None:
+            self._file_filter = FileFilter(self.get_path_filters(), self.get_mime_filters())
+        return self._file_filter
+
     def get_query_names(self):
         return self._metadata["queries"]
 
+    def get_query_rules(self, query_name):
+        if query_name not in self._metadata["queries"]:
+            raise TagEngineException(f"Query {query_name} does not exist")
+        return self._metadata["queries"][query_name]
+
     def get_categories(self):
         return list(self._metadata["tags"].keys())
 
     def get_tags_for_category(self, category):
         return list(self._metadata["tags"][category])
 
-    def get_tags_for_file(self, file_path, category):
-        file_hash = get_file_hash(file_path)
-        if file_hash is None:
-            raise TagEngineException(f"File {file_path} does not exist")
-
-        if file_hash not in self._metadata["files"]:
+    def get_tags_for_file(self, file_entry, category):
+        tags = file_entry.tags
+        if tags is None:
             return None
 
-        tags = self._metadata["files"][file_hash]["tags"]
         if category is None:
             return tags
         else:
@@ -96,67 +364,83 @@ class TagEngineMetadata:
                 return None
             return tags[category]
 
-    def add_category(self, category):
+    def _validate_new_category(self, category):
         if not re.match(name_regex, category):
             raise TagEngineException(f'Category name "{category}" is not allowed.')
-        if category in self._metadata["tags"]:
+        if category in self.get_categories():
             raise TagEngineException(f'Category name "{category}" already exists.')
-        self._metadata["tags"][category] = []
+
+    def _validate_new_tag(self, category, new_tag):
+        if not re.match(name_regex, new_tag):
+            raise TagEngineException(f'Tag name "{new_tag}" is not allowed.')
+        if category not in self.get_categories():
+            raise TagEngineException(f'Unknown category "{category}"', developer_error=True)
+        if new_tag in self.get_tags_for_category(category):
+            raise TagEngineException(f'Tag "{new_tag}" already exists')
+
+    def add_category(self, category):
+        self._validate_new_category(category)
+        self._record({"operation": "add_category", "category": category})
 
     def add_mime_filter(self, new_filter):
         if new_filter not in self._metadata["filters"]["mime"]:
-            self._metadata["filters"]["mime"].append(new_filter)
+            self._record({"operation": "add_filter", "kind": "mime", "filter": new_filter})
 
     def add_path_filter(self, new_filter):
         if new_filter not in self._metadata["filters"]["path"]:
-            self._metadata["filters"]["path"].append(new_filter)
+            self._record({"operation": "add_filter", "kind": "path", "filter": new_filter})
 
     def add_query(self, query_name, rules):
         if query_name in self._metadata["queries"]:
             raise TagEngineException(f'Query "{query_name}" already exists')
-        self._metadata["queries"][query_name] = rules
+        compile_query(rules)
+        self._record({"operation": "add_query", "query": query_name, "rules": rules})
 
     def add_tag(self, category, new_tag):
-        if not re.match(name_regex, new_tag):
-            raise TagEngineException(f'Tag name "{new_tag}" is not allowed.')
-        if category not in self._metadata["tags"]:
-            raise TagEngineException(f'Unknown category "{category}"', developer_error=True)
-        if new_tag in self._metadata["tags"][category]:
-            raise TagEngineException(f'Tag "{new_tag}" already exists')
-        self._metadata["tags"][category].append(new_tag)
-
-    def set_tags(self, file_path, tags, root_dir_path):
-        file_hash = get_file_hash(file_path)
-        if file_hash is None:
-            raise TagEngineException(f"File {file_path} does not exist")
-
-        # Create new entry, if file is not in the database. Only tags can be changed. Rest of the metadata
-        # is constant. Hash is unique identifier. Path is only for sanity checks, but it's not used.
-        if file_hash not in self._metadata["files"]:
-            self._metadata["files"][file_hash] = {
-                "path": str(file_path.absolute().relative_to(root_dir_path)),
-                "tags": {},
+        self._validate_new_tag(category, new_tag)
+        self._record({"operation": "add_tag", "category": category, "tag": new_tag})
+
+    def set_tags(self, file_entry, tags, root_dir_path):
+        # Tags before the first unsaved change are needed, if changes of another process have to be merged
+        if file_entry.hash not in self._base_tags:
+            self._base_tags[file_entry.hash] = self._files.get_tags(file_entry.hash)
+        self._record(
+            {
+                "operation": "set_tags",
+                "hash": file_entry.hash,
+                "path": str(file_entry.path.absolute().relative_to(root_dir_path)),
+                "tags": dict(tags),
             }
+        )
+        file_entry.tags = self._files.get_tags(file_entry.hash)
+
+    def set_file_path(self, file_entry, root_dir_path):
+        self._record(
+            {
+                "operation": "set_path",
+                "hash": file_entry.hash,
+                "path": str(file_entry.path.absolute().relative_to(root_dir_path)),
+            }
+        )
 
-        # Entry must be created by now. Set the tags
-        self._metadata["files"][file_hash]["tags"] = dict(tags)
+    def remove_file(self, file_entry):
+        self._record({"operation": "remove_file", "hash": file_entry.hash})
 
-    def matches_query(self, query_name, file_path):
-        if query_name not in self._metadata["queries"]:
-            raise TagEngineException(f"Query {query_name} does not exist")
-        query_rules = self._metadata["queries"][query_name]
-        tags = self.get_tags_for_file(file_path, None)
+    def set_fingerprint_strategy(self, strategy, rekeyed_files):
+        # rekeyed_files maps old fingerprints to lists of (new fingerprint, relative path) pairs
+        rekeyed_files = {file_hash: [list(new_file) for new_file in new_files] for file_hash, new_files in rekeyed_files.items()}
+        self._record({"operation": "set_fingerprint", "strategy": strategy, "files": rekeyed_files})
 
-        if not tags:
-            return False
+    def matches_query(self, query_name, file_entry):
+        return compile_query(self.get_query_rules(query_name)).matches(file_entry.tags)
 
-        # All categories in the query rules must be matched.
-        for category, required_values in query_rules.items():
-            if category not in tags:
-                return False
+    def _get_hashes_matching_query(self, query_rules):
+        # Query is evaluated over bitsets of the tag index, not file by file
+        return self._files.get_hashes(compile_query(query_rules).evaluate(self._files))
 
-            for required_value in required_values:
-                if required_value not in tags[category]:
-                    return False
+    def get_entries_matching_rules(self, query_rules, root_dir_path):
+        for file_hash in self._get_hashes_matching_query(query_rules):
+            yield FileEntry(root_dir_path / self._files.get_path(file_hash), file_hash, self._files.get_tags(file_hash))
 
-        return True
+    def get_entries_matching_query(self, query_name, root_dir_path):
+        return self.get_entries_matching_rules(self.get_query_rules(query_name), root_dir_path)
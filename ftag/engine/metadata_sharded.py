@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+
+from engine.metadata import TagEngineMetadata, backup_version_interval
+
+shard_directory_name = "shards"
+backup_directory_name = "backups"
+num_shards = 256
+
+
+def _write_json_atomically(content, file_path, tmp_file):
+    with open(tmp_file, "w") as file:
+        json.dump(content, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, file_path)
+
+
+class ShardedTagEngineMetadata(TagEngineMetadata):
+    # Same interface as TagEngineMetadata, but files are split into shards by the first byte of their hash.
+    # Categories, tags, filters, queries and the version are kept in a small manifest. A save writes only the
+    # shards changed since the previous save, each one under a name with its version, so the shards of the stored
+    # manifest are left intact. Manifest is written last and only then the shards it no longer uses are removed.
+    # No journal is used, a save is cheap already.
+    def __init__(self, metadata_file_path, fingerprint_cache=None):
+        self._dirty_shards = set()
+        self._shard_versions = {}
+        self._backup_version = 0
+        self._shard_files = []
+        super().__init__(metadata_file_path, fingerprint_cache)
+
+    @staticmethod
+    def _get_shard(file_hash):
+        return int(file_hash[0:2], 16)
+
+    @staticmethod
+    def _get_shard_file_name(shard, version):
+        return f"{shard:02x}_v{version}.json"
+
+    @staticmethod
+    def _get_legacy_shard_file_name(shard):
+        # Shards written before the names had versions are used, until they are written again
+        return f"{shard:02x}.json"
+
+    @staticmethod
+    def _get_shard_file_path(shard_directory, shard, version):
+        shard_file_path = shard_directory / ShardedTagEngineMetadata._get_shard_file_name(shard, version)
+        legacy_shard_file_path = shard_directory / ShardedTagEngineMetadata._get_legacy_shard_file_name(shard)
+        if not shard_file_path.is_file() and legacy_shard_file_path.is_file():
+            return legacy_shard_file_path
+        return shard_file_path
+
+    def load_empty(self):
+        super().load_empty()
+        self._dirty_shards = set(range(num_shards))
+
+    def load(self, manifest_file_path):
+        with open(manifest_file_path, "r") as file:
+            manifest = json.load(file)
+        self._shard_versions = {int(shard): version for shard, version in manifest.pop("shard_versions").items()}
+        self._backup_version = manifest.pop("backup_version")
+        manifest["files"] = {}
+        TagEngineMetadata.import_content(self, manifest)
+        self._dirty_shards = set()
+
+        # Shards are opened right away, while the caller holds the lock, but read only once files are needed.
+        # Open shards keep the content matching the manifest, even if another process replaces or removes them.
+        shard_directory = manifest_file_path.parent / shard_directory_name
+        try:
+            for shard, shard_version in sorted(self._shard_versions.items()):
+                self._shard_files.append(open(ShardedTagEngineMetadata._get_shard_file_path(shard_directory, shard, shard_version), "r"))
+        except BaseException:
+            self.close()
+            raise
+        shard_files = self._shard_files
+        self._defer_file_loading(lambda files: ShardedTagEngineMetadata._read_shards(shard_files, files))
+
+    @staticmethod
+    def _read_shards(shard_files, files):
+        # Files are added shard by shard, so the whole database is never held as nested dicts
+        def read_files():
+            for shard_file in shard_files:
+                with shard_file:
+                    for file_hash, file_metadata in json.load(shard_file).items():
+                        yield file_hash, file_metadata["path"], file_metadata["tags"]
+
+        files.add_files(read_files())
+
+    def close(self):
+        for shard_file in self._shard_files:
+            shard_file.close()
+        self._shard_files = []
+        super().close()
+
+    def import_content(self, content):
+        super().import_content(content)
+        self._dirty_shards = set(range(num_shards))
+
+    def _apply_record(self, record):
+        super()._apply_record(record)
+        if "hash" in record:
+            self._dirty_shards.add(ShardedTagEngineMetadata._get_shard(record["hash"]))
+        elif record["operation"] == "set_fingerprint":
+            self._dirty_shards = set(range(num_shards))
+
+    def save(self, manifest_file_path, tmp_file):
+        self._metadata["version"] += 1
+        self.compact(manifest_file_path, tmp_file)
+
+    def compact(self, manifest_file_path, tmp_file):
+        version = self._metadata["version"]
+        metadata_directory = manifest_file_path.parent
+        shard_directory = metadata_directory / shard_directory_name
+        shard_directory.mkdir(exist_ok=True, parents=True)
+
+        # Only the dirty shards are collected, other files are skipped without being decoded. If no shard changed,
+        # files don't even have to be loaded.
+        shards = {shard: {} for shard in self._dirty_shards}
+        if shards:
+            for file_hash, path, tags in self._files.items(self._dirty_shards):
+                shards[ShardedTagEngineMetadata._get_shard(file_hash)][file_hash] = {"path": path, "tags": tags}
+        for shard, files in shards.items():
+            if files:
+                shard_file_name = ShardedTagEngineMetadata._get_shard_file_name(shard, version)
+                _write_json_atomically(files, shard_directory / shard_file_name, shard_directory / f"tmp_{shard_file_name}")
+                self._shard_versions[shard] = version
+            elif shard in self._shard_versions:
+                # Empty shards are not stored
+                del self._shard_versions[shard]
+        self._dirty_shards = set()
+        self._clear_pending_records()
+
+        # Backups are incremental. Every backup holds the manifest and shards changed since the previous one.
+        previous_backup_version = self._backup_version
+        make_backup = version // backup_version_interval > previous_backup_version // backup_version_interval
+        if make_backup:
+            self._backup_version = version
+
+        manifest = dict(self._metadata)
+        manifest["shard_versions"] = {str(shard): shard_version for shard, shard_version in sorted(self._shard_versions.items())}
+        manifest["backup_version"] = self._backup_version
+        _write_json_atomically(manifest, manifest_file_path, tmp_file)
+
+        # Other shard files are older versions, or they were left by a save which didn't finish
+        shard_file_names = set(os.listdir(shard_directory))
+        used_shard_file_names = set()
+        for shard, shard_version in self._shard_versions.items():
+            shard_file_name = ShardedTagEngineMetadata._get_shard_file_name(shard, shard_version)
+            if shard_file_name not in shard_file_names:
+                shard_file_name = ShardedTagEngineMetadata._get_legacy_shard_file_name(shard)
+            used_shard_file_names.add(shard_file_name)
+        for shard_file_name in shard_file_names - used_shard_file_names:
+            (shard_directory / shard_file_name).unlink(missing_ok=True)
+
+        if make_backup:
+            backup_directory = metadata_directory / backup_directory_name / f"v{str(version).zfill(4)}"
+            backup_directory.mkdir(exist_ok=True, parents=True)
+            shutil.copy(manifest_file_path, backup_directory / manifest_file_path.name)
+            for shard, shard_version in self._shard_versions.items():
+                if shard_version > previous_backup_version:
+                    shard_file_path = ShardedTagEngineMetadata._get_shard_file_path(shard_directory, shard, shard_version)
+                    shutil.copy(shard_file_path, backup_directory / shard_file_path.name)
@@ -0,0 +1,347 @@
+import json
+
+from engine.exception import TagEngineException
+from engine.file_entry import FileEntry
+from engine.metadata import TagEngineMetadata, backup_version_interval, merge_tags
+from engine.misc import head_fingerprint_strategy
+from engine.query import compile_query
+
+# Another process may be writing. It holds the database only until it saves, so wait for it.
+busy_timeout_seconds = 60
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    category_id INTEGER NOT NULL REFERENCES categories(id),
+    name TEXT NOT NULL,
+    UNIQUE (category_id, name)
+);
+CREATE TABLE IF NOT EXISTS filters (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    pattern TEXT NOT NULL,
+    UNIQUE (kind, pattern)
+);
+CREATE TABLE IF NOT EXISTS queries (
+    name TEXT PRIMARY KEY,
+    rules TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_categories (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    category_id INTEGER NOT NULL REFERENCES categories(id),
+    PRIMARY KEY (file_id, category_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS file_tags (
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    tag_id INTEGER NOT NULL REFERENCES tags(id),
+    PRIMARY KEY (file_id, tag_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS file_tags_by_tag ON file_tags (tag_id, file_id);
+INSERT OR IGNORE INTO info (key, value) VALUES ('version', 0);
+INSERT OR IGNORE INTO info (key, value) VALUES ('fingerprint', '{head_fingerprint_strategy}');
+"""
+tags_batch_size = 500
+
+
+class SqliteTagEngineMetadata(TagEngineMetadata):
+    # Same interface as TagEngineMetadata, but backed by an SQLite database. Nothing is loaded upfront. Every
+    # change is done in the current transaction, which is committed by save(). A file entry (its categories and
+    # tags) is therefore always updated atomically.
+    def __init__(self, metadata_file_path, fingerprint_cache=None):
+        self._fingerprint_cache = fingerprint_cache
+        self._file_filter = None
+        self.load(metadata_file_path)
+
+    def load_empty(self):
+        raise TagEngineException("SQLite metadata must be backed by a file", developer_error=True)
+
+    def load(self, metadata_file_path):
+        import sqlite3  # Imported only for SQLite databases, it's slow to import
+
+        metadata_file_path.parent.mkdir(exist_ok=True, parents=False)
+        self._connection = sqlite3.connect(metadata_file_path, timeout=busy_timeout_seconds)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(schema)
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def save(self, metadata_file_path, tmp_file):
+        version = self.get_version() + 1
+        self._connection.execute("UPDATE info SET value = ? WHERE key = 'version'", (version,))
+        self._connection.commit()
+
+        if version % backup_version_interval == 0:
+            backup_version = str(version).zfill(4)
+            backup_file_name = f"{metadata_file_path.stem}_v{backup_version}{metadata_file_path.suffix}"
+            backup_file_path = metadata_file_path.parent / backup_file_name
+            import sqlite3
+
+            backup_connection = sqlite3.connect(backup_file_path)
+            self._connection.backup(backup_connection)
+            backup_connection.close()
+
+    def compact(self, metadata_file_path, tmp_file):
+        self._connection.commit()
+        self._connection.execute("VACUUM")
+
+    def get_version(self):
+        return self._connection.execute("SELECT value FROM info WHERE key = 'version'").fetchone()[0]
+
+    def get_fingerprint_strategy(self):
+        return self._connection.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()[0]
+
+    def export_content(self):
+        content = {
+            "files": {},
+            "filters": {
+                "mime": self.get_mime_filters(),
+                "path": self.get_path_filters(),
+            },
+            "tags": {category: self.get_tags_for_category(category) for category in self.get_categories()},
+            "version": self.get_version(),
+            "queries": {query_name: self.get_query_rules(query_name) for query_name in self.get_query_names()},
+            "fingerprint": self.get_fingerprint_strategy(),
+        }
+        for file_id, file_hash, path in self._connection.execute("SELECT id, hash, path FROM files ORDER BY id"):
+            content["files"][file_hash] = {
+                "path": path,
+                "tags": self._get_tags_for_file_id(file_id),
+            }
+        return content
+
+    def import_content(self, content):
+        TagEngineMetadata._validate_content(content)
+
+        for category, tags in content["tags"].items():
+            self.add_category(category)
+            for tag in tags:
+                self.add_tag(category, tag)
+        for new_filter in content["filters"]["mime"]:
+            self.add_mime_filter(new_filter)
+        for new_filter in content["filters"]["path"]:
+            self.add_path_filter(new_filter)
+        for query_name, rules in content["queries"].items():
+            self.add_query(query_name, rules)
+        for file_hash, file_metadata in content["files"].items():
+            file_id = self._get_or_create_file_id(file_hash, file_metadata["path"])
+            self._set_tags_for_file_id(file_id, file_metadata["tags"], create_missing_tags=True)
+        self._connection.execute("UPDATE info SET value = ? WHERE key = 'version'", (content["version"],))
+        fingerprint_strategy = content.get("fingerprint", head_fingerprint_strategy)
+        self._connection.execute("UPDATE info SET value = ? WHERE key = 'fingerprint'", (fingerprint_strategy,))
+
+    def resolve_file_with_hash(self, file_path, file_hash):
+        row = self._connection.execute("SELECT id FROM files WHERE hash = ?", (file_hash,)).fetchone()
+        tags = self._get_tags_for_file_id(row[0]) if row is not None else None
+        return FileEntry(file_path, file_hash, tags)
+
+    def get_files(self, root_dir_path):
+        for file_id, file_hash, path in self._connection.execute("SELECT id, hash, path FROM files ORDER BY id").fetchall():
+            yield FileEntry(root_dir_path / path, file_hash, self._get_tags_for_file_id(file_id))
+
+    def _get_tags_for_file_id(self, file_id):
+        tags = {}
+        categories_query = """
+            SELECT categories.name FROM file_categories
+            JOIN categories ON categories.id = file_categories.category_id
+            WHERE file_categories.file_id = ? ORDER BY categories.id
+        """
+        for (category,) in self._connection.execute(categories_query, (file_id,)):
+            tags[category] = []
+
+        tags_query = """
+            SELECT categories.name, tags.name FROM file_tags
+            JOIN tags ON tags.id = file_tags.tag_id
+            JOIN categories ON categories.id = tags.category_id
+            WHERE file_tags.file_id = ? ORDER BY tags.id
+        """
+        for category, tag in self._connection.execute(tags_query, (file_id,)):
+            tags[category].append(tag)
+        return tags
+
+    def get_mime_filters(self):
+        return self._get_filters("mime")
+
+    def get_path_filters(self):
+        return self._get_filters("path")
+
+    def _get_filters(self, kind):
+        rows = self._connection.execute("SELECT pattern FROM filters WHERE kind = ? ORDER BY id", (kind,))
+        return [pattern for (pattern,) in rows]
+
+    def get_query_names(self):
+        return [query_name for (query_name,) in self._connection.execute("SELECT name FROM queries ORDER BY rowid")]
+
+    def get_query_rules(self, query_name):
+        row = self._connection.execute("SELECT rules FROM queries WHERE name = ?", (query_name,)).fetchone()
+        if row is None:
+            raise TagEngineException(f"Query {query_name} does not exist")
+        return json.loads(row[0])
+
+    def get_categories(self):
+        return [category for (category,) in self._connection.execute("SELECT name FROM categories ORDER BY id")]
+
+    def get_tags_for_category(self, category):
+        query = "SELECT tags.name FROM tags JOIN categories ON categories.id = tags.category_id WHERE categories.name = ? ORDER BY tags.id"
+        return [tag for (tag,) in self._connection.execute(query, (category,))]
+
+    def add_category(self, category):
+        self._validate_new_category(category)
+        self._connection.execute("INSERT INTO categories (name) VALUES (?)", (category,))
+
+    def add_mime_filter(self, new_filter):
+        self._connection.execute("INSERT OR IGNORE INTO filters (kind, pattern) VALUES ('mime', ?)", (new_filter,))
+        self._file_filter = None
+
+    def add_path_filter(self, new_filter):
+        self._connection.execute("INSERT OR IGNORE INTO filters (kind, pattern) VALUES ('path', ?)", (new_filter,))
+        self._file_filter = None
+
+    def add_query(self, query_name, rules):
+        if query_name in self.get_query_names():
+            raise TagEngineException(f'Query "{query_name}" already exists')
+        compile_query(rules)
+        self._connection.execute("INSERT INTO queries (name, rules) VALUES (?, ?)", (query_name, json.dumps(rules)))
+
+    def add_tag(self, category, new_tag):
+        self._validate_new_tag(category, new_tag)
+        category_id = self._get_category_id(category)
+        self._connection.execute("INSERT INTO tags (category_id, name) VALUES (?, ?)", (category_id, new_tag))
+
+    def _get_category_id(self, category):
+        row = self._connection.execute("SELECT id FROM categories WHERE name = ?", (category,)).fetchone()
+        if row is None:
+            raise TagEngineException(f'Unknown category "{category}"')
+        return row[0]
+
+    def _get_tag_id(self, category_id, tag, create_missing_tags):
+        row = self._connection.execute("SELECT id FROM tags WHERE category_id = ? AND name = ?", (category_id, tag)).fetchone()
+        if row is not None:
+            return row[0]
+
+        # JSON metadata allows files to keep tags, which are no longer listed in their category
+        if not create_missing_tags:
+            raise TagEngineException(f'Unknown tag "{tag}"')
+        return self._connection.execute("INSERT INTO tags (category_id, name) VALUES (?, ?)", (category_id, tag)).lastrowid
+
+    def _get_or_create_file_id(self, file_hash, path):
+        row = self._connection.execute("SELECT id FROM files WHERE hash = ?", (file_hash,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._connection.execute("INSERT INTO files (hash, path) VALUES (?, ?)", (file_hash, path)).lastrowid
+
+    def _set_tags_for_file_id(self, file_id, tags, create_missing_tags=False):
+        self._connection.execute("DELETE FROM file_categories WHERE file_id = ?", (file_id,))
+        self._connection.execute("DELETE FROM file_tags WHERE file_id = ?", (file_id,))
+        for category, values in tags.items():
+            category_id = self._get_category_id(category)
+            self._connection.execute("INSERT INTO file_categories (file_id, category_id) VALUES (?, ?)", (file_id, category_id))
+            for value in values:
+                tag_id = self._get_tag_id(category_id, value, create_missing_tags)
+                self._connection.execute("INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES (?, ?)", (file_id, tag_id))
+
+    def set_tags(self, file_entry, tags, root_dir_path):
+        # Use a savepoint, so invalid tags don't leave the file entry half-updated in the current transaction.
+        # Releasing the outermost savepoint would commit, so make sure the transaction is already open. It's opened
+        # for writing right away, so the tags read below can't be changed by another process before they're written.
+        if not self._connection.in_transaction:
+            self._connection.execute("BEGIN IMMEDIATE")
+        self._connection.execute("SAVEPOINT set_tags")
+        try:
+            path = str(file_entry.path.absolute().relative_to(root_dir_path))
+            file_id = self._get_or_create_file_id(file_entry.hash, path)
+
+            # Another process may have changed the tags since the file was resolved
+            current_tags = self._get_tags_for_file_id(file_id)
+            if current_tags != (file_entry.tags or {}):
+                tags = merge_tags(file_entry.tags, tags, current_tags)
+            self._set_tags_for_file_id(file_id, tags)
+        except:
+            self._connection.execute("ROLLBACK TO set_tags")
+            raise
+        finally:
+            self._connection.execute("RELEASE set_tags")
+        file_entry.tags = {category: list(values) for category, values in tags.items()}
+
+    def set_file_path(self, file_entry, root_dir_path):
+        path = str(file_entry.path.absolute().relative_to(root_dir_path))
+        self._connection.execute("UPDATE files SET path = ? WHERE hash = ?", (path, file_entry.hash))
+
+    def remove_file(self, file_entry):
+        row = self._connection.execute("SELECT id FROM files WHERE hash = ?", (file_entry.hash,)).fetchone()
+        if row is None:
+            return
+        self._connection.execute("DELETE FROM file_categories WHERE file_id = ?", (row[0],))
+        self._connection.execute("DELETE FROM file_tags WHERE file_id = ?", (row[0],))
+        self._connection.execute("DELETE FROM files WHERE id = ?", (row[0],))
+
+    def set_fingerprint_strategy(self, strategy, rekeyed_files):
+        for file_hash, new_files in rekeyed_files.items():
+            row = self._connection.execute("SELECT id FROM files WHERE hash = ?", (file_hash,)).fetchone()
+            if row is None:
+                continue
+
+            # First file takes over the entry, copies get their own entries with the same tags
+            (new_file_hash, path), copies = new_files[0], new_files[1:]
+            self._connection.execute("UPDATE files SET hash = ?, path = ? WHERE id = ?", (new_file_hash, path, row[0]))
+            for new_file_hash, path in copies:
+                file_id = self._get_or_create_file_id(new_file_hash, path)
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO file_categories (file_id, category_id) SELECT ?, category_id FROM file_categories WHERE file_id = ?",
+                    (file_id, row[0]),
+                )
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO file_tags (file_id, tag_id) SELECT ?, tag_id FROM file_tags WHERE file_id = ?",
+                    (file_id, row[0]),
+                )
+        self._connection.execute("UPDATE info SET value = ? WHERE key = 'fingerprint'", (strategy,))
+
+    def get_entries_matching_rules(self, query_rules, root_dir_path):
+        # Query is translated to SQL. Every term is resolved through the file_tags index. Tags of matching files
+        # are fetched in batches, not file by file.
+        condition, parameters = compile_query(query_rules).get_sql()
+        query = f"""
+            SELECT id, hash, path FROM files
+            WHERE EXISTS (SELECT 1 FROM file_categories WHERE file_categories.file_id = files.id) AND {condition}
+        """
+        files = self._connection.execute(query, parameters).fetchall()
+        for batch_start in range(0, len(files), tags_batch_size):
+            batch = files[batch_start : batch_start + tags_batch_size]
+            tags_by_file_id = self._get_tags_for_file_ids([file_id for file_id, _, _ in batch])
+            for file_id, file_hash, path in batch:
+                yield FileEntry(root_dir_path / path, file_hash, tags_by_file_id[file_id])
+
+    def _get_tags_for_file_ids(self, file_ids):
+        tags_by_file_id = {file_id: {} for file_id in file_ids}
+        placeholders = ", ".join("?" * len(file_ids))
+        categories_query = f"""
+            SELECT file_categories.file_id, categories.name FROM file_categories
+            JOIN categories ON categories.id = file_categories.category_id
+            WHERE file_categories.file_id IN ({placeholders}) ORDER BY categories.id
+        """
+        for file_id, category in self._connection.execute(categories_query, file_ids):
+            tags_by_file_id[file_id][category] = []
+
+        tags_query = f"""
+            SELECT file_tags.file_id, categories.name, tags.name FROM file_tags
+            JOIN tags ON tags.id = file_tags.tag_id
+            JOIN categories ON categories.id = tags.category_id
+            WHERE file_tags.file_id IN ({placeholders}) ORDER BY tags.id
+        """
+        for file_id, category, tag in self._connection.execute(tags_query, file_ids):
+            tags_by_file_id[file_id][category].append(tag)
+        return tags_by_file_id
@@ -2,24 +2,210 @@ import hashlib
 import mimetypes
 import os
 
+from engine.exception import TagEngineException
+from engine.profiler import profiler
 
-def get_file_hash(file_path):
+
+head_fingerprint_strategy = "head"
+sampled_fingerprint_strategy = "sampled"
+fingerprint_strategies = [head_fingerprint_strategy, sampled_fingerprint_strategy]
+head_fingerprint_size = 128 * 1024
+sampled_fingerprint_block_size = 64 * 1024
+prefetch_size = 4 * 1024 * 1024
+full_hash_block_size = 1024 * 1024
+
+# Prefixes of well known file formats. Containers are told apart by the type stored right after their header.
+magic_signatures = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"\x1a\x45\xdf\xa3", "video/x-matroska"),
+    (b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", "application/vnd.ms-asf"),
+    (b"ID3", "audio/mpeg"),
+    (b"\xff\xfb", "audio/mpeg"),
+    (b"\xff\xf3", "audio/mpeg"),
+    (b"\xff\xf2", "audio/mpeg"),
+    (b"\xff\xf1", "audio/aac"),
+    (b"\xff\xf9", "audio/aac"),
+    (b"fLaC", "audio/flac"),
+    (b"OggS", "audio/ogg"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (b"Rar!\x1a\x07", "application/vnd.rar"),
+    (b"\x7fELF", "application/x-executable"),
+]
+riff_mime_types = {b"WEBP": "image/webp", b"AVI ": "video/x-msvideo", b"WAVE": "audio/x-wav"}
+iso_brand_mime_types = {
+    b"qt  ": "video/quicktime",
+    b"M4A ": "audio/mp4",
+    b"M4B ": "audio/mp4",
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"mif1": "image/heif",
+    b"avif": "image/avif",
+}
+sniffed_mime_types = {mime_type for _, mime_type in magic_signatures} | set(riff_mime_types.values()) | set(iso_brand_mime_types.values()) | {"video/mp4", "video/webm"}
+# Containers of many formats. A more specific type from the extension is kept for them (e.g. .docx in zip).
+generic_mime_types = {"application/zip", "application/gzip", "application/vnd.ms-asf", "audio/ogg"}
+
+
+def _read_block(fd, size, offset):
+    # pread may return less than requested, e.g. if the file is being truncated
+    chunks = []
+    while size > 0:
+        chunk = os.pread(fd, size, offset)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        profiler.count("bytes_read", len(chunk))
+        size -= len(chunk)
+        offset += len(chunk)
+    return b"".join(chunks)
+
+
+def _sniff_mime_type(head):
+    # Mime type from the content of the file. None if the header is not recognized.
+    if head.startswith(b"RIFF"):
+        return riff_mime_types.get(head[8:12])
+    if head.startswith(b"ftyp", 4):
+        return iso_brand_mime_types.get(head[8:12], "video/mp4")
+    for signature, mime_type in magic_signatures:
+        if head.startswith(signature):
+            if mime_type == "video/x-matroska" and b"webm" in head[:64]:
+                return "video/webm"
+            return mime_type
+    return None
+
+
+def _probe_file(file_path, file_size, strategy):
+    # Fingerprint and mime type of the file. Every strategy starts with a block from the head of the file, which
+    # is used for both, so the file is read only once.
+    hash_function = hashlib.new("blake2b")
+    fd = os.open(file_path, os.O_RDONLY)
     try:
-        file_size = os.path.getsize(file_path)
+        if strategy == head_fingerprint_strategy:
+            # First 128 KiB of the file
+            head = _read_block(fd, min(head_fingerprint_size, file_size), 0)
+            hash_function.update(head)
+        elif strategy == sampled_fingerprint_strategy:
+            # Size and blocks from the head, middle and tail of the file. The cost is fixed no matter how large
+            # the file is, but files sharing headers (e.g. videos of the same container) are still told apart.
+            # Small files are read whole, with a single call.
+            hash_function.update(file_size.to_bytes(8, "little"))
+            block_size = sampled_fingerprint_block_size
+            if file_size <= 3 * block_size:
+                head = _read_block(fd, file_size, 0)
+                hash_function.update(head)
+            else:
+                blocks = [_read_block(fd, block_size, offset) for offset in [0, (file_size - block_size) // 2, file_size - block_size]]
+                head = blocks[0]
+                for block in blocks:
+                    hash_function.update(block)
+        else:
+            raise TagEngineException(f'Unknown fingerprint strategy "{strategy}"', developer_error=True)
+    finally:
+        os.close(fd)
+    return hash_function.hexdigest()[0:48], _sniff_mime_type(head)
+
+
+def _probe(file_path, strategy, fingerprint_cache, file_stat, needs_mime_type):
+    # Stat can be passed by the caller, if it's already known (e.g. from a directory walk)
+    if file_stat is None:
+        try:
+            file_stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None, None
+
+    # Only read the file if we don't have an up-to-date fingerprint. Cache holding fingerprints of another strategy
+    # is not used, so cached and computed fingerprints never mix. Entries cached before mime types were sniffed
+    # only have the fingerprint.
+    if fingerprint_cache is not None and fingerprint_cache.get_strategy() != strategy:
+        fingerprint_cache = None
+    if fingerprint_cache is not None:
+        if needs_mime_type:
+            result = fingerprint_cache.get_probe(file_stat)
+        else:
+            file_hash = fingerprint_cache.get(file_stat)
+            result = (file_hash, None) if file_hash is not None else None
+        if result is not None:
+            profiler.count("fingerprint_cache_hits")
+            return result
+        profiler.count("fingerprint_cache_misses")
+
+    try:
+        with profiler.phase("fingerprint.compute"):
+            file_hash, mime_type = _probe_file(file_path, file_stat.st_size, strategy)
     except FileNotFoundError:
-        return None
-    bytes_left = min(128 * 1024, file_size)
-    chunk_size = 8096
+        return None, None
+    profiler.count("files_hashed")
+    if fingerprint_cache is not None:
+        fingerprint_cache.put(file_stat, file_hash, mime_type)
+    return file_hash, mime_type
 
+
+def get_file_hash(file_path, strategy, fingerprint_cache=None, file_stat=None):
+    return _probe(file_path, strategy, fingerprint_cache, file_stat, False)[0]
+
+
+def probe_file(file_path, strategy, fingerprint_cache=None, file_stat=None):
+    # Returns the fingerprint and the mime type sniffed from the content of the file, both None if the file
+    # doesn't exist. Mime type is None for unrecognized content.
+    return _probe(file_path, strategy, fingerprint_cache, file_stat, True)
+
+
+def get_full_file_hash(file_path):
+    # Hash of the whole content, for when a fingerprint is not enough. It's never cached.
     hash_function = hashlib.new("blake2b")
-    with open(file_path, "rb") as file:
-        while bytes_left != 0:
-            current_chunk_size = min(chunk_size, bytes_left)
-            chunk = file.read(current_chunk_size)
-            hash_function.update(chunk)
-            bytes_left -= current_chunk_size
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        with profiler.phase("full_hash.compute"):
+            offset = 0
+            while True:
+                block = _read_block(fd, full_hash_block_size, offset)
+                if not block:
+                    break
+                hash_function.update(block)
+                offset += len(block)
+    finally:
+        os.close(fd)
     return hash_function.hexdigest()[0:48]
 
 
-def get_file_mime_type(file_path):
+def prefetch_file(file_path, size=prefetch_size):
+    # Asks the OS to read the beginning of the file into its cache, so an application opening it starts faster
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        else:
+            _read_block(fd, size, 0)
+    finally:
+        os.close(fd)
+
+
+def guess_mime_type(file_path):
+    # Mime type from the extension only, the file is not touched
     return mimetypes.guess_type(file_path)[0]
+
+
+def combine_mime_types(content_mime_type, extension_mime_type):
+    # Mime type sniffed from the content, or the one from the extension if the content wasn't recognized.
+    # For generic containers (zip, gzip, asf, ogg), a type from the extension is preferred, unless it's one of
+    # the types which are sniffed themselves (e.g. .docx stays docx, but a .png holding a zip is a zip).
+    if content_mime_type is None:
+        return extension_mime_type
+    if content_mime_type in generic_mime_types and extension_mime_type is not None and extension_mime_type not in sniffed_mime_types:
+        return extension_mime_type
+    return content_mime_type
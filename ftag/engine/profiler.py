@@ -0,0 +1,93 @@
+import contextlib
+import threading
+import time
+
+profile_environment_variable = "FTAG_PROFILE"
+
+
+class Profiler:
+    # Collects wall time of named phases and counters of an ftag run. It's disabled by default and then every call
+    # returns right away, so instrumentation can stay in hot paths. Phases can nest and can run in worker threads,
+    # time of a phase is summed over all its calls.
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._start_time = None
+        self._phases = {}
+        self._counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self._start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed_iteration(self, name, iterable):
+        # Only the time spent producing items is measured, not the time the consumer spends on them
+        if not self.enabled:
+            return iterable
+        return self._timed_iteration(name, iterable)
+
+    def _timed_iteration(self, name, iterable):
+        iterator = iter(iterable)
+        duration = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    duration += time.perf_counter() - start
+                yield item
+        finally:
+            self.add_time(name, duration)
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            calls, total = self._phases.get(name, (0, 0.0))
+            self._phases[name] = (calls + 1, total + seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get_report(self):
+        with self._lock:
+            return {
+                "wall_time": time.perf_counter() - self._start_time if self._start_time is not None else 0.0,
+                "phases": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in sorted(self._phases.items())},
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def format_report(self):
+        report = self.get_report()
+        lines = [f"Profile: {report['wall_time']:.3f}s wall time"]
+        if report["phases"]:
+            lines.append(f"  {'phase': <32} {'calls': >8} {'seconds': >10}")
+            for name, phase in report["phases"].items():
+                lines.append(f"  {name: <32} {phase['calls']: >8} {phase['seconds']: >10.3f}")
+        if report["counters"]:
+            lines.append(f"  {'counter': <32} {'value': >19}")
+            for name, value in report["counters"].items():
+                lines.append(f"  {name: <32} {value: >19}")
+        return "\n".join(lines)
+
+
+# Single instance shared by the whole process
+profiler = Profiler()
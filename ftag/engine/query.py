@@ -0,0 +1,223 @@
+import fnmatch
+import functools
+import re
+
+from engine.exception import TagEngineException
+
+# Query expressions combine terms with AND, OR, NOT and parentheses. Adjacent terms are joined with AND.
+# A term is "category:tag", "category:*" (category is assigned, possibly with no tags) or just "tag" (tag in any
+# category). Category and tag names can contain wildcards (* ? [...]). Only files with some tags can match.
+token_regex = re.compile(r"\(|\)|[^\s()]+")
+keywords = ["AND", "OR", "NOT"]
+wildcard_characters = "*?["
+
+
+def _is_pattern(name):
+    return any(character in name for character in wildcard_characters)
+
+
+def _translate_glob(pattern):
+    # SQLite GLOB understands the same wildcards, except that fnmatch uses [!...] and GLOB [^...]
+    return pattern.replace("[!", "[^")
+
+
+class _TagTerm:
+    def __init__(self, category, tag):
+        self._category = category
+        self._tag = tag
+
+    def matches(self, tags):
+        for category, values in tags.items():
+            if not fnmatch.fnmatchcase(category, self._category):
+                continue
+            if self._tag is None or any(fnmatch.fnmatchcase(value, self._tag) for value in values):
+                return True
+        return False
+
+    def evaluate(self, file_table, all_bits):
+        if not _is_pattern(self._category) and (self._tag is None or not _is_pattern(self._tag)):
+            return file_table.get_bitset((self._category, self._tag))
+
+        bits = 0
+        for category, tag in file_table.get_keys():
+            if (tag is None) != (self._tag is None) or not fnmatch.fnmatchcase(category, self._category):
+                continue
+            if tag is None or fnmatch.fnmatchcase(tag, self._tag):
+                bits |= file_table.get_bitset((category, tag))
+        return bits
+
+    def get_sql(self):
+        if self._tag is None:
+            condition = """files.id IN (
+                SELECT file_id FROM file_categories JOIN categories ON categories.id = file_categories.category_id
+                WHERE categories.name GLOB ?
+            )"""
+            return condition, [_translate_glob(self._category)]
+
+        condition = """files.id IN (
+            SELECT file_id FROM file_tags
+            JOIN tags ON tags.id = file_tags.tag_id
+            JOIN categories ON categories.id = tags.category_id
+            WHERE categories.name GLOB ? AND tags.name GLOB ?
+        )"""
+        return condition, [_translate_glob(self._category), _translate_glob(self._tag)]
+
+
+class _And:
+    def __init__(self, operands):
+        self._operands = operands
+
+    def matches(self, tags):
+        return all(operand.matches(tags) for operand in self._operands)
+
+    def evaluate(self, file_table, all_bits):
+        bits = all_bits
+        for operand in self._operands:
+            bits &= operand.evaluate(file_table, all_bits)
+            if not bits:
+                break
+        return bits
+
+    def get_sql(self):
+        conditions, parameters = zip(*(operand.get_sql() for operand in self._operands))
+        return "(" + " AND ".join(conditions) + ")", [parameter for group in parameters for parameter in group]
+
+
+class _Or:
+    def __init__(self, operands):
+        self._operands = operands
+
+    def matches(self, tags):
+        return any(operand.matches(tags) for operand in self._operands)
+
+    def evaluate(self, file_table, all_bits):
+        bits = 0
+        for operand in self._operands:
+            bits |= operand.evaluate(file_table, all_bits)
+        return bits
+
+    def get_sql(self):
+        conditions, parameters = zip(*(operand.get_sql() for operand in self._operands))
+        return "(" + " OR ".join(conditions) + ")", [parameter for group in parameters for parameter in group]
+
+
+class _Not:
+    def __init__(self, operand):
+        self._operand = operand
+
+    def matches(self, tags):
+        return not self._operand.matches(tags)
+
+    def evaluate(self, file_table, all_bits):
+        return all_bits & ~self._operand.evaluate(file_table, all_bits)
+
+    def get_sql(self):
+        condition, parameters = self._operand.get_sql()
+        return f"NOT {condition}", parameters
+
+
+class Query:
+    # Compiled query expression. Can be matched against tags of a single file, or evaluated for all files at
+    # once over bitsets of the file table.
+    def __init__(self, root):
+        self._root = root
+
+    def matches(self, tags):
+        if not tags:
+            return False
+        return self._root.matches(tags)
+
+    def evaluate(self, file_table):
+        all_bits = file_table.get_tagged_bitset()
+        return self._root.evaluate(file_table, all_bits) & all_bits
+
+    def get_sql(self):
+        return self._root.get_sql()
+
+
+class _Parser:
+    def __init__(self, expression):
+        self._expression = expression
+        self._tokens = token_regex.findall(expression)
+        self._position = 0
+
+    def _error(self, message):
+        return TagEngineException(f'Invalid query "{self._expression}": {message}')
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self._position += 1
+        return token
+
+    def parse(self):
+        if not self._tokens:
+            raise self._error("query is empty")
+        root = self._parse_or()
+        if self._peek() is not None:
+            raise self._error(f'unexpected "{self._peek()}"')
+        return root
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._peek() == "OR":
+            self._next()
+            operands.append(self._parse_and())
+        return operands[0] if len(operands) == 1 else _Or(operands)
+
+    def _parse_and(self):
+        operands = [self._parse_not()]
+        while self._peek() not in [None, ")", "OR"]:
+            if self._peek() == "AND":
+                self._next()
+            operands.append(self._parse_not())
+        return operands[0] if len(operands) == 1 else _And(operands)
+
+    def _parse_not(self):
+        if self._peek() == "NOT":
+            self._next()
+            return _Not(self._parse_not())
+        return self._parse_atom()
+
+    def _parse_atom(self):
+        token = self._next()
+        if token is None:
+            raise self._error("unexpected end")
+        if token == "(":
+            node = self._parse_or()
+            if self._next() != ")":
+                raise self._error('missing ")"')
+            return node
+        if token == ")" or token in keywords:
+            raise self._error(f'unexpected "{token}"')
+
+        category, separator, tag = token.rpartition(":")
+        if not separator:
+            category = "*"
+        if not category or not tag:
+            raise self._error(f'invalid term "{token}"')
+        return _TagTerm(category, None if tag == "*" else tag)
+
+
+def _rules_to_expression(rules):
+    # Rules of queries created before query expressions: all categories must be assigned and all listed
+    # tags must be present.
+    if not rules:
+        return "*:*"
+    terms = [f"{category}:*" for category in rules]
+    terms += [f"{category}:{value}" for category, values in rules.items() for value in values]
+    return " AND ".join(terms)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_query(expression):
+    return Query(_Parser(expression).parse())
+
+
+def compile_query(rules):
+    # Queries are stored either as an expression, or as a dict of rules
+    if isinstance(rules, str):
+        return parse_query(rules)
+    return parse_query(_rules_to_expression(rules))
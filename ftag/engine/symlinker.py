@@ -1,8 +1,12 @@
+import collections
 import os
-import shutil
 
 from engine.exception import TagEngineException
-from engine.misc import get_file_hash
+from engine.profiler import profiler
+
+# Links are created relative to an open directory, if the platform allows it, so the path is not resolved again
+# for every link in the same directory
+dir_fd_supported = {os.open, os.readlink, os.symlink, os.unlink} <= os.supports_dir_fd
 
 
 class Symlinker:
@@ -12,14 +16,16 @@ class Symlinker:
     def get_root(self):
         return self._symlink_root
 
-    def _get_symlink_path(self, category, value, file_path):
-        file_hash = get_file_hash(file_path)[:6]
+    def _get_symlink_path(self, category, value, file_entry):
+        file_path = file_entry.path
+        file_hash = file_entry.hash[:6]
         symlink_dir = self._symlink_root / category / value
         symlink_name = f"{file_path.stem}_{file_hash}{file_path.suffix}"
         return symlink_dir / symlink_name
 
-    def _get_query_symlink_path(self, query_name, file_path):
-        file_hash = get_file_hash(file_path)
+    def _get_query_symlink_path(self, query_name, file_entry):
+        file_path = file_entry.path
+        file_hash = file_entry.hash
         symlink_dir = self._symlink_root / "queries" / query_name
         symlink_name = f"{file_hash}{file_path.suffix}"
         return symlink_dir / symlink_name
@@ -29,15 +35,43 @@ class Symlinker:
         if not real_file_path.is_absolute():
             raise TagEngineException(f"Path {real_file_path} is not absolute")
 
-        symlink_path.parent.mkdir(parents=True, exist_ok=True)
-        symlink_path.unlink(missing_ok=True)
-        os.symlink(real_file_path, symlink_path)
+        self._link(str(real_file_path), str(symlink_path))
+
+    def _link(self, target, symlink_path, dir_fd=None):
+        # Creating the link is tried first, so a new link costs a single syscall. An existing link is read and
+        # replaced only if it points elsewhere. Missing directories are created only when the link fails.
+        try:
+            os.symlink(target, symlink_path, dir_fd=dir_fd)
+        except FileExistsError:
+            try:
+                current_target = os.readlink(symlink_path, dir_fd=dir_fd)
+            except OSError:
+                # Not a symlink
+                current_target = None
+            if current_target == target:
+                profiler.count("symlinks_unchanged")
+                return
+            os.unlink(symlink_path, dir_fd=dir_fd)
+            os.symlink(target, symlink_path, dir_fd=dir_fd)
+        except FileNotFoundError:
+            if dir_fd is not None:
+                raise
+            os.makedirs(os.path.dirname(symlink_path), exist_ok=True)
+            os.symlink(target, symlink_path)
+        profiler.count("symlinks_created")
+
+    def _remove_symlink(self, symlink_path, dir_fd=None):
+        try:
+            os.unlink(symlink_path, dir_fd=dir_fd)
+        except FileNotFoundError:
+            return
+        profiler.count("symlinks_removed")
 
     def _setup_symlink(self, real_file_path, symlink_path, create):
         if create:
             self._create_symlink(real_file_path, symlink_path)
         else:
-            symlink_path.unlink(missing_ok=True)
+            self._remove_symlink(symlink_path)
 
     def cleanup(self):
         if not self._symlink_root.exists():
@@ -45,24 +79,118 @@ class Symlinker:
 
         for file_path in self._symlink_root.rglob("*"):
             if file_path.is_file() or file_path.is_symlink():
-                file_path.unlink()
+                self._remove_symlink(file_path)
 
-    def setup_symlinks_for_query(self, query_name, matching_files, create):
-        for file_path in matching_files:
-            file_path_absolute = file_path.absolute()
-            symlink_path = self._get_query_symlink_path(query_name, file_path)
+    def setup_symlinks_for_query(self, query_name, matching_entries, create):
+        for file_entry in matching_entries:
+            file_path_absolute = file_entry.path.absolute()
+            symlink_path = self._get_query_symlink_path(query_name, file_entry)
             self._setup_symlink(file_path_absolute, symlink_path, create)
 
-    def setup_symlinks_for_file(self, file_path, matching_tags, matching_queries, create):
-        file_path_absolute = file_path.absolute()
+    def get_symlinks_for_file(self, file_entry, matching_queries):
+        file_path_absolute = file_entry.path.absolute()
 
-        # Iterate over all tags assigned to this file and remove its symlinks
-        for category, values in matching_tags.items():
+        # Symlinks for all tags assigned to this file
+        for category, values in file_entry.tags.items():
             for value in values:
-                symlink_path = self._get_symlink_path(category, value, file_path)
-                self._setup_symlink(file_path_absolute, symlink_path, create)
+                yield self._get_symlink_path(category, value, file_entry), file_path_absolute
 
-        # Iterate over all queries and remove symlinks for matching ones.
+        # Symlinks for all queries matching this file
         for query_name in matching_queries:
-            symlink_path = self._get_query_symlink_path(query_name, file_path)
+            yield self._get_query_symlink_path(query_name, file_entry), file_path_absolute
+
+    def setup_symlinks_for_file(self, file_entry, matching_queries, create):
+        for symlink_path, file_path_absolute in self.get_symlinks_for_file(file_entry, matching_queries):
             self._setup_symlink(file_path_absolute, symlink_path, create)
+
+    def update_symlinks(self, old_symlinks, new_symlinks):
+        # Replace symlinks of a single file. Both arguments are {symlink_path: real_file_path} dicts.
+        for symlink_path in old_symlinks.keys() - new_symlinks.keys():
+            self._remove_symlink(symlink_path)
+        for symlink_path, real_file_path in new_symlinks.items():
+            self._create_symlink(real_file_path, symlink_path)
+
+    def _scan_existing_symlinks(self):
+        existing = {}
+        if not os.path.isdir(self._symlink_root):
+            return existing
+        if hasattr(os, "fwalk") and dir_fd_supported:
+            walk = ((root, files, root_fd) for root, dirs, files, root_fd in os.fwalk(self._symlink_root))
+        else:
+            walk = ((root, files, None) for root, dirs, files in os.walk(self._symlink_root))
+
+        for root, files, root_fd in walk:
+            for file_name in files:
+                symlink_path = os.path.join(root, file_name)
+                try:
+                    existing[symlink_path] = os.readlink(file_name if root_fd is not None else symlink_path, dir_fd=root_fd)
+                except OSError:
+                    # Not a symlink. The tree is managed by ftag, so it shouldn't be here.
+                    existing[symlink_path] = None
+        return existing
+
+    def _apply_directory_changes(self, directory, changes):
+        # Changes are (name, target, exists) tuples, target is None for links to remove. The directory is opened
+        # once for all of them.
+        if not dir_fd_supported:
+            for name, target, exists in changes:
+                self._apply_change(os.path.join(directory, name), target, exists, None)
+            return
+
+        try:
+            directory_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        except FileNotFoundError:
+            os.makedirs(directory, exist_ok=True)
+            directory_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, target, exists in changes:
+                self._apply_change(name, target, exists, directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _apply_change(self, symlink_path, target, exists, dir_fd):
+        if exists:
+            self._remove_symlink(symlink_path, dir_fd)
+        if target is not None:
+            self._link(target, symlink_path, dir_fd)
+
+    def reconcile(self, desired_symlinks):
+        # Bring the symlink tree to the desired state of {symlink_path: real_file_path} by touching only the links
+        # that differ. Unchanged links stay in place, so the tree remains usable while this runs. Changes are
+        # grouped by directory, so each directory is resolved once and every changed link costs about one syscall.
+        statistics = {
+            "added": 0,
+            "removed": 0,
+            "retargeted": 0,
+            "unchanged": 0,
+        }
+
+        desired_symlinks = {str(symlink_path): str(real_file_path) for symlink_path, real_file_path in desired_symlinks.items()}
+        with profiler.phase("symlinks.scan"):
+            existing_symlinks = self._scan_existing_symlinks()
+
+        changes = collections.defaultdict(list)
+        for symlink_path in existing_symlinks:
+            if symlink_path not in desired_symlinks:
+                directory, name = os.path.split(symlink_path)
+                changes[directory].append((name, None, True))
+                statistics["removed"] += 1
+
+        for symlink_path, real_file_path in desired_symlinks.items():
+            exists = symlink_path in existing_symlinks
+            if exists and existing_symlinks[symlink_path] == real_file_path:
+                statistics["unchanged"] += 1
+                profiler.count("symlinks_unchanged")
+                continue
+
+            if exists:
+                statistics["retargeted"] += 1
+            else:
+                statistics["added"] += 1
+            directory, name = os.path.split(symlink_path)
+            changes[directory].append((name, real_file_path, exists))
+
+        for directory, directory_changes in changes.items():
+            self._apply_directory_changes(directory, directory_changes)
+
+        return statistics
@@ -0,0 +1,58 @@
+import csv
+import json
+
+from engine.exception import TagEngineException
+
+
+class TagRecord:
+    # Single (path, category, tags) record of a batch import. Records which could not be parsed carry an error
+    # instead, so they can be reported together with the other per-record errors.
+    def __init__(self, source, path, category, tags, error=None):
+        self.source = source
+        self.path = path
+        self.category = category
+        self.tags = tags
+        self.error = error
+
+
+def _split_tags(tags):
+    if isinstance(tags, str):
+        return [tag for tag in tags.replace(";", " ").split() if tag]
+    return list(tags)
+
+
+def _read_csv_records(file, source_name):
+    # Columns are: path, category, tags. Tags are separated by spaces or semicolons. A header row is optional.
+    for line_number, row in enumerate(csv.reader(file), 1):
+        source = f"{source_name}:{line_number}"
+        if len(row) == 0 or row[0].startswith("#"):
+            continue
+        if line_number == 1 and [column.strip().lower() for column in row] == ["path", "category", "tags"]:
+            continue
+        if len(row) != 3:
+            yield TagRecord(source, None, None, None, f"Expected 3 columns, got {len(row)}")
+            continue
+        yield TagRecord(source, row[0], row[1].strip(), _split_tags(row[2]))
+
+
+def _read_jsonl_records(file, source_name):
+    # Each line is an object with "path", "category" and "tags" fields. Tags can be a list or a string.
+    for line_number, line in enumerate(file, 1):
+        source = f"{source_name}:{line_number}"
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            record = json.loads(line)
+            yield TagRecord(source, record["path"], record["category"], _split_tags(record["tags"]))
+        except (ValueError, KeyError, TypeError) as e:
+            yield TagRecord(source, None, None, None, f"Invalid record: {e}")
+
+
+def read_tag_records(file, record_format, source_name):
+    if record_format == "csv":
+        return _read_csv_records(file, source_name)
+    elif record_format == "jsonl":
+        return _read_jsonl_records(file, source_name)
+    else:
+        raise TagEngineException(f'Unknown record format "{record_format}"')
@@ -0,0 +1,126 @@
+import fnmatch
+import os
+
+from engine.profiler import profiler
+
+ignore_file_name = ".ftagignore"
+
+
+class _IgnoreRule:
+    # Single line of an ignore file. Patterns containing a slash are matched against the path relative to
+    # the directory of the ignore file, other patterns against the entry name. Trailing slash matches only
+    # directories.
+    def __init__(self, base_directory, pattern):
+        self._base_directory = base_directory
+        self._directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        self._match_full_path = "/" in pattern
+        self._pattern = pattern.lstrip("/")
+
+    def matches(self, relative_path, name, is_directory):
+        if self._directory_only and not is_directory:
+            return False
+        if not self._match_full_path:
+            return fnmatch.fnmatchcase(name, self._pattern)
+
+        if self._base_directory:
+            relative_path = relative_path[len(self._base_directory) + 1 :]
+        return fnmatch.fnmatchcase(relative_path, self._pattern)
+
+
+def _read_ignore_rules(ignore_file_path, base_directory):
+    rules = []
+    try:
+        with open(ignore_file_path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    rules.append(_IgnoreRule(base_directory, line))
+    except OSError:
+        pass
+    return rules
+
+
+def get_ignore_rules(root_dir, relative_path, is_directory):
+    # Collects rules from ignore files of all ancestors of the path. These are the rules applying to the path
+    # itself. Returns None if the path or any of its ancestors is ignored.
+    rules = []
+    directory = ""
+    names = relative_path.split(os.sep)
+    for index, name in enumerate(names):
+        rules = rules + _read_ignore_rules(os.path.join(root_dir, directory, ignore_file_name), directory)
+        current_path = os.path.join(directory, name) if directory else name
+        current_is_directory = is_directory or index < len(names) - 1
+        if any(rule.matches(current_path, name, current_is_directory) for rule in rules):
+            return None
+        directory = current_path
+    return rules
+
+
+def is_ignored_file(root_dir, relative_path):
+    if os.path.basename(relative_path) == ignore_file_name:
+        return True
+    return get_ignore_rules(root_dir, relative_path, False) is None
+
+
+def walk_files(root_dir, excluded_dirs, file_filter, use_ignore_files=True, start_directory=None):
+    # Walks the directory tree with os.scandir. Excluded directories, ignored entries and directories which
+    # cannot contain files passing the path filters are skipped as a whole, without descending into them.
+    # Yields (path, stat) pairs for files passing the path filters. Stat comes from the scan, so it's not repeated.
+    # Mime filters are left to the caller, they need the content of the file.
+    # Walk can start in a subdirectory. Paths are still filtered relative to the root directory then.
+    excluded_dirs = {str(path) for path in excluded_dirs}
+    if start_directory is None:
+        stack = [(str(root_dir), "", [])]
+    else:
+        relative_directory = os.path.relpath(start_directory, root_dir)
+        ignore_rules = get_ignore_rules(str(root_dir), relative_directory, True) if use_ignore_files else []
+        if ignore_rules is None or str(start_directory) in excluded_dirs:
+            return
+        if not file_filter.may_match_directory(relative_directory):
+            return
+        stack = [(str(start_directory), relative_directory, ignore_rules)]
+    while stack:
+        directory, relative_directory, ignore_rules = stack.pop()
+        try:
+            with os.scandir(directory) as iterator:
+                entries = list(iterator)
+        except OSError:
+            continue
+        profiler.count("directories_scanned")
+
+        # Ignore file applies to its directory and all subdirectories
+        if use_ignore_files and any(entry.name == ignore_file_name for entry in entries):
+            ignore_file_path = os.path.join(directory, ignore_file_name)
+            ignore_rules = ignore_rules + _read_ignore_rules(ignore_file_path, relative_directory)
+
+        subdirectories = []
+        for entry in entries:
+            relative_path = os.path.join(relative_directory, entry.name) if relative_directory else entry.name
+            try:
+                is_directory = entry.is_dir()
+            except OSError:
+                continue
+            if any(rule.matches(relative_path, entry.name, is_directory) for rule in ignore_rules):
+                continue
+
+            if is_directory:
+                # Like os.walk, do not follow symlinks to directories
+                if entry.is_symlink() or entry.path in excluded_dirs:
+                    continue
+                if not file_filter.may_match_directory(relative_path):
+                    continue
+                subdirectories.append((entry.path, relative_path, ignore_rules))
+            else:
+                if entry.name == ignore_file_name or not file_filter.matches_path(relative_path):
+                    continue
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    # Broken symlink or a file removed during the walk
+                    continue
+                profiler.count("files_walked")
+                yield entry.path, file_stat
+
+        # Visit subdirectories in the order they were listed
+        stack.extend(reversed(subdirectories))
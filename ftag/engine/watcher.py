@@ -0,0 +1,132 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from engine.exception import TagEngineException
+from engine.walker import walk_files
+
+in_attrib = 0x00000004
+in_close_write = 0x00000008
+in_moved_from = 0x00000040
+in_moved_to = 0x00000080
+in_create = 0x00000100
+in_delete = 0x00000200
+in_delete_self = 0x00000400
+in_move_self = 0x00000800
+in_q_overflow = 0x00004000
+in_ignored = 0x00008000
+in_onlydir = 0x01000000
+in_isdir = 0x40000000
+watch_mask = in_close_write | in_attrib | in_moved_from | in_moved_to | in_create | in_delete | in_delete_self | in_move_self | in_onlydir
+
+inotify_event_header = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    # Watches the directory tree with Linux inotify. Every directory gets its own watch. New directories are
+    # watched as soon as their creation is reported. read_changes returns absolute paths of changed entries.
+    def __init__(self, root_dir, excluded_dirs):
+        self._excluded_dirs = {str(path) for path in excluded_dirs}
+        self._directories = {}
+
+        library_name = ctypes.util.find_library("c")
+        if library_name is None:
+            raise TagEngineException("Could not find libc, inotify is not available")
+        self._libc = ctypes.CDLL(library_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise TagEngineException("inotify is not available on this platform")
+
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise TagEngineException(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self._add_watches(str(root_dir))
+
+    def close(self):
+        os.close(self._fd)
+
+    def _add_watches(self, top_directory):
+        for directory, subdirectories, _ in os.walk(top_directory):
+            subdirectories[:] = [name for name in subdirectories if os.path.join(directory, name) not in self._excluded_dirs]
+            watch_descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), watch_mask)
+            if watch_descriptor < 0:
+                error_code = ctypes.get_errno()
+                if error_code == errno.ENOSPC:
+                    raise TagEngineException("Limit of inotify watches reached. Raise fs.inotify.max_user_watches or use polling.")
+                continue  # Directory was removed in the meantime
+            self._directories[watch_descriptor] = directory
+
+    def read_changes(self, timeout):
+        # Returns a set of changed paths and a flag telling, whether events were lost and the whole tree has
+        # to be rescanned.
+        changed_paths = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed_paths, False
+
+        buffer = os.read(self._fd, 1024 * 1024)
+        offset = 0
+        rescan = False
+        while offset < len(buffer):
+            watch_descriptor, mask, _, name_length = inotify_event_header.unpack_from(buffer, offset)
+            offset += inotify_event_header.size
+            name = os.fsdecode(buffer[offset : offset + name_length].rstrip(b"\0"))
+            offset += name_length
+
+            if mask & in_q_overflow:
+                rescan = True
+                continue
+            if mask & in_ignored:
+                self._directories.pop(watch_descriptor, None)
+                continue
+
+            directory = self._directories.get(watch_descriptor)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if path in self._excluded_dirs:
+                continue
+            changed_paths.add(path)
+
+            # Start watching new directories. Files created before the watch was added are picked up by the
+            # caller, which scans the reported directory.
+            if mask & in_isdir and mask & (in_create | in_moved_to):
+                self._add_watches(path)
+        return changed_paths, rescan
+
+
+class PollingWatcher:
+    # Fallback for systems without inotify. The tree is scanned periodically and compared with the previous
+    # scan. Only stat information is compared, files are not read.
+    def __init__(self, root_dir, excluded_dirs, file_filter, poll_interval):
+        self._root_dir = root_dir
+        self._excluded_dirs = excluded_dirs
+        self._file_filter = file_filter
+        self._poll_interval = poll_interval
+        self._snapshot = self._scan()
+        self._next_scan_time = time.monotonic() + poll_interval
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        snapshot = {}
+        for file_path, file_stat in walk_files(self._root_dir, self._excluded_dirs, self._file_filter):
+            snapshot[file_path] = (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+        return snapshot
+
+    def read_changes(self, timeout):
+        remaining_time = self._next_scan_time - time.monotonic()
+        if remaining_time > timeout:
+            time.sleep(timeout)
+            return set(), False
+        time.sleep(max(remaining_time, 0))
+
+        snapshot = self._scan()
+        self._next_scan_time = time.monotonic() + self._poll_interval
+        changed_paths = {path for path in snapshot.keys() | self._snapshot.keys() if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed_paths, False
@@ -1,22 +1,52 @@
 #!/bin/python
 
 import argparse
+import atexit
+import json
+import os
 import sys
+import time
 from pathlib import Path
 
 from engine import *
 from utils import *
 
+default_poll_interval = 2.0
+
 
 # ------------------------------------- Helper functions
-def load_engine():
+def load_engine(args, verbose=True):
     engine = TagEngine()
     if engine.get_state() != TagEngineState.Loaded:
         error("Failed to load ftags metadata")
-    print(f"Ftag database found at {engine.get_metadata_file()}")
+    if verbose:
+        print(f"Ftag database found at {engine.get_metadata_file()}")
+    if args.jobs is not None:
+        engine.set_worker_count(args.jobs)
     return engine
 
 
+def setup_profiling(profile_output):
+    # Profiling is enabled by --profile or by the environment variable. Value "1" prints a summary, anything
+    # else is a path of the JSON report. Report is written when the command exits, even after an error.
+    if profile_output is None:
+        profile_output = os.environ.get(profile_environment_variable)
+        if not profile_output:
+            return
+        if profile_output == "1":
+            profile_output = "-"
+
+    def report():
+        if profile_output == "-":
+            print(profiler.format_report(), file=sys.stderr)
+        else:
+            with open(profile_output, "w") as file:
+                json.dump(profiler.get_report(), file, indent=4)
+
+    profiler.enable()
+    atexit.register(report)
+
+
 # ------------------------------------- Core operations
 def initialize_database():
     engine = TagEngine()
@@ -50,10 +80,33 @@ def add_path_filter(engine, new_filter):
     engine.save()
 
 
-def create_query(engine):
-    # Read rules
-    rules = {}
-    for category in engine.get_categories():
+def migrate(engine, storage):
+    try:
+        engine.migrate(TagEngineStorage(storage))
+    except TagEngineException as e:
+        error(e.message)
+    info(f"Migrated ftag database to {engine.get_metadata_file()}")
+
+
+def set_fingerprint_strategy(engine, strategy):
+    try:
+        statistics = engine.set_fingerprint_strategy(strategy)
+    except TagEngineException as e:
+        error(e.message)
+    if statistics["num_lost_files"] > 0:
+        warning(f"{statistics['num_lost_files']} files were not found. They keep old fingerprints and can be removed with --reconcile --prune.")
+    info(f"Rekeyed {statistics['num_rekeyed_files']} files to {strategy} fingerprints.")
+
+
+def compact(engine):
+    engine.compact()
+    info(f"Compacted ftag database {engine.get_metadata_file()}")
+
+
+def create_query(engine, expression):
+    # Read rules, unless the query is given as an expression
+    rules = expression if expression else {}
+    for category in engine.get_categories() if not expression else []:
         # Display available tags for this category
         available_values = engine.get_tags_for_category(category)
         for index, value in enumerate(available_values):
@@ -67,32 +120,150 @@ def create_query(engine):
     # Read query name
     query_name = read_identifier("query name")
 
-    engine.add_query(query_name, rules)
+    try:
+        num_unresolved_files = engine.add_query(query_name, rules)
+    except TagEngineException as e:
+        error(e.message)
     engine.save()
+    if num_unresolved_files > 0:
+        warning(f"Skipped {num_unresolved_files} files which were moved or changed. Run --reconcile and create the query again to include them.")
+
+
+def search(engine, expression, output_format, check_existence):
+    # Answered from the metadata alone. Nothing else is printed to stdout, so the output can be piped.
+    try:
+        file_entries = sorted(engine.search(expression), key=lambda file_entry: str(file_entry.path))
+    except TagEngineException as e:
+        error(e.message, file=sys.stderr)
 
+    num_missing_files = 0
+    for file_entry in file_entries:
+        if check_existence and not file_entry.path.is_file():
+            num_missing_files += 1
+            continue
+        if output_format == "json":
+            print(json.dumps({"path": str(file_entry.path), "hash": file_entry.hash, "tags": file_entry.tags}))
+        elif output_format == "nul":
+            sys.stdout.write(f"{file_entry.path}\0")
+        else:
+            print(file_entry.path)
+    if num_missing_files > 0:
+        warning(f"Skipped {num_missing_files} files which no longer exist.", file=sys.stderr)
+
+
+def generate(engine, rebuild):
+    statistics = engine.generate_all_symlinks(reconcile=not rebuild)
+    engine.save_fingerprint_cache()
 
-def generate(engine):
-    engine.generate_all_symlinks()
+    if statistics is not None:
+        num_changed = statistics["added"] + statistics["removed"] + statistics["retargeted"]
+        info(
+            f"Changed {num_changed} symlinks: {statistics['added']} added, {statistics['removed']} removed, "
+            f"{statistics['retargeted']} retargeted, {statistics['unchanged']} unchanged."
+        )
+
+
+def watch(engine, debounce_seconds, poll_interval):
+    try:
+        changes = engine.watch(debounce_seconds, poll_interval)
+    except TagEngineException as e:
+        if poll_interval is not None:
+            error(e.message)
+        warning(f"{e.message} Falling back to polling.")
+        changes = engine.watch(debounce_seconds, default_poll_interval)
+
+    info("Watching for changes. Press Ctrl+C to stop.")
+    try:
+        for statistics in changes:
+            print(
+                f"{time.strftime('%H:%M:%S')} Updated symlinks of {statistics['num_updated_files']} files, "
+                f"removed symlinks of {statistics['num_removed_files']} files."
+            )
+    except KeyboardInterrupt:
+        changes.close()
+        engine.save_fingerprint_cache()
 
 
 def tag_all(engine):
-    statistics = engine.get_untagged_files_statistics()
+    statistics, untagged_files = engine.scan_untagged_files()
     print(f"Tagging {statistics['num_untagged_files']} out of {statistics['num_taggable_files']} taggable files.")
 
-    for file_to_tag in engine.get_untagged_files():
-        default_app = BackgroundProcess.open_file_in_default_application(file_to_tag)
+    for file_to_tag in untagged_files:
+        default_app = BackgroundProcess.open_file_in_default_application(file_to_tag.path)
         tag_file(engine, file_to_tag, True)
         while not read_yes_no("Do you want tag a next file? Say 'no' to re-tag this one."):
             tag_file(engine, file_to_tag, False)
         default_app.kill()
 
 
+def reconcile_moved_files(engine, prune):
+    statistics = engine.reconcile_moved_files(prune)
+    if statistics["moved_files"] or (prune and statistics["orphaned_files"]):
+        engine.save()
+    engine.save_fingerprint_cache()
+
+    for old_entry, new_entry in statistics["moved_files"]:
+        print(f"Moved: {old_entry.path} -> {new_entry.path}")
+    for orphaned_entry in statistics["orphaned_files"]:
+        print(f"{'Pruned' if prune else 'Orphaned'}: {orphaned_entry.path}")
+    info(f"Found {len(statistics['moved_files'])} moved files and {len(statistics['orphaned_files'])} orphaned files.")
+    if statistics["orphaned_files"] and not prune:
+        info("Use --prune to remove orphaned files from the database.")
+
+
+def find_duplicates(engine, full_hash):
+    statistics = engine.find_duplicates(full_hash)
+    engine.save_fingerprint_cache()
+
+    # Copies share their database entry, so every group has a single set of tags
+    wasted_bytes = 0
+    for size, file_entries in statistics["duplicates"]:
+        wasted_bytes += size * (len(file_entries) - 1)
+        tags = file_entries[0].tags
+        tags_description = "; ".join(f"{category}: {', '.join(values)}" for category, values in tags.items()) if tags is not None else "<UNTAGGED>"
+        print(f"{len(file_entries)} copies of {size} bytes, tags {tags_description}")
+        for file_entry in file_entries:
+            print(f"  {file_entry.path}")
+    num_files = sum(len(file_entries) for _, file_entries in statistics["duplicates"])
+    info(
+        f"Found {len(statistics['duplicates'])} groups of {num_files} duplicate files, {wasted_bytes} bytes in redundant copies. "
+        f"Fingerprinted {statistics['num_fingerprinted_files']} files sharing their size."
+    )
+    if statistics["num_collisions"] > 0:
+        warning(f"{statistics['num_collisions']} fingerprints are shared by files with different content, so these files share tags. Use --fingerprint sampled to tell them apart.")
+
+
+def import_tags(engine, input_path, record_format):
+    if record_format is None:
+        record_format = "csv" if input_path.suffix.lower() == ".csv" else "jsonl"
+
+    start_time = time.perf_counter()
+    try:
+        if str(input_path) == "-":
+            statistics = engine.import_tags(read_tag_records(sys.stdin, record_format, "stdin"))
+        else:
+            with open(input_path, "r", newline="") as file:
+                statistics = engine.import_tags(read_tag_records(file, record_format, input_path.name))
+    except (OSError, TagEngineException) as e:
+        error(getattr(e, "message", e))
+    engine.save()
+    duration = time.perf_counter() - start_time
+
+    for source, message in statistics["errors"]:
+        warning(f"{source}: {message}")
+    records_per_second = statistics["num_records"] / duration if duration > 0 else 0
+    info(
+        f"Imported {statistics['num_records']} records for {statistics['num_files']} files in {duration:.2f}s "
+        f"({records_per_second:.0f} records/s). {len(statistics['errors'])} records failed."
+    )
+
+
 def tag_file(engine, file_to_tag, only_uninitialized_categories):
     if len(engine.get_categories()) == 0:
         print("Database doesn't contain any categories.")
         return
 
-    print(f"Tagging file {file_to_tag}")
+    print(f"Tagging file {file_to_tag.path}")
     for category in engine.get_categories():
         available_values = engine.get_tags_for_category(category)
         current_values = engine.get_tags_for_file(file_to_tag, category)
@@ -158,38 +329,86 @@ if __name__ == "__main__":
     config_args.add_argument("-c", "--add_category", type=str, help="Add a new category to the ftag database.")
     config_args.add_argument("-m", "--add_mime_filter", type=str, help=f"Add a new mime filter as a regex checked against mime type. {filters_help}")
     config_args.add_argument("-p", "--add_path_filter", type=str, help=f"Add a new path filter as a regex checked against file path. {filters_help}")
-    config_args.add_argument("-q", "--create_query", action="store_true", help=f"Creates a new query.")
+    query_help = "Expression combines category:tag terms with AND, OR, NOT and parentheses. category:* matches an assigned category, wildcards are allowed in names."
+    config_args.add_argument("-q", "--create_query", nargs="?", const="", metavar="EXPRESSION", help=f"Creates a new query. Tags are selected interactively, unless an expression is given. {query_help}")
+    config_args.add_argument("--compact", action="store_true", help="Merge the journal of recent changes into the ftag database.")
+    config_args.add_argument("--migrate", choices=[s.value for s in TagEngineStorage], help="Convert the ftag database to a different storage format.")
+    config_args.add_argument("--fingerprint", choices=fingerprint_strategies, help="Change how files are fingerprinted and rekey files in the database. 'sampled' reads the head, middle and tail of a file.")
     tagging_args = parser.add_argument_group("File operations")
     tagging_args.add_argument("-g", "--generate", action="store_true", help="Generate symlinks")
+    tagging_args.add_argument("--rebuild", action="store_true", help="Used with --generate. Remove all symlinks and create them from scratch.")
+    tagging_args.add_argument("-s", "--search", type=str, metavar="EXPRESSION", help=f"Print files matching a query expression. {query_help}")
+    tagging_args.add_argument("--search_format", choices=["lines", "json", "nul"], default="lines", help="Used with --search. Print paths one per line, JSON objects one per line or NUL-separated paths.")
+    tagging_args.add_argument("--check", action="store_true", help="Used with --search. Skip files which no longer exist.")
+    tagging_args.add_argument("-w", "--watch", action="store_true", help="Watch the directory tree and keep symlinks up to date until interrupted.")
+    tagging_args.add_argument("--poll", type=float, metavar="SECONDS", help="Used with --watch. Scan the tree periodically instead of using inotify.")
+    tagging_args.add_argument("--debounce", type=float, default=1.0, metavar="SECONDS", help="Used with --watch. Wait until changes settle down for this long.")
+    tagging_args.add_argument("--reconcile", action="store_true", help="Find moved and renamed files, update their paths and symlinks. List files which no longer exist.")
+    tagging_args.add_argument("--prune", action="store_true", help="Used with --reconcile. Remove files which no longer exist from the database.")
+    tagging_args.add_argument("--duplicates", action="store_true", help="List groups of files with the same content and their tags. Copies of a file share one entry and tags in the database.")
+    tagging_args.add_argument("--full_hash", action="store_true", help="Used with --duplicates. Confirm duplicates by hashing the whole content of files, not just their fingerprints.")
     tagging_args.add_argument("-t", "--tag_all", action="store_true", help="Iterate over all untagged files and tag them.")
     tagging_args.add_argument("-f", "--file", type=Path, help="Path to the file to tag interactively")
+    tagging_args.add_argument("--import_tags", type=Path, help="Set tags from a CSV or JSONL file of (path, category, tags) records. Use - to read from stdin.")
+    tagging_args.add_argument("--import_format", choices=["csv", "jsonl"], help="Format of --import_tags input. Guessed from the file extension by default.")
+    tagging_args.add_argument("-j", "--jobs", type=int, help="Number of threads used to hash files.")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="PATH", help=f"Measure time of individual phases and count files, bytes and symlinks. Summary is printed to stderr on exit, or a JSON report is written to PATH. Can be also enabled by the {profile_environment_variable} environment variable.")
     args = parser.parse_args()
+    setup_profiling(args.profile)
 
     if args.initialize:
         initialize_database()
     elif args.add_category:
-        engine = load_engine()
+        engine = load_engine(args)
         add_category(engine, args.add_category)
     elif args.add_mime_filter:
-        engine = load_engine()
+        engine = load_engine(args)
         add_mime_filter(engine, args.add_mime_filter)
     elif args.add_path_filter:
-        engine = load_engine()
+        engine = load_engine(args)
         add_path_filter(engine, args.add_path_filter)
-    elif args.create_query:
-        engine = load_engine()
-        create_query(engine)
+    elif args.compact:
+        engine = load_engine(args)
+        compact(engine)
+    elif args.migrate:
+        engine = load_engine(args)
+        migrate(engine, args.migrate)
+    elif args.fingerprint:
+        engine = load_engine(args)
+        set_fingerprint_strategy(engine, args.fingerprint)
+    elif args.create_query is not None:
+        engine = load_engine(args)
+        create_query(engine, args.create_query)
     elif args.generate:
-        engine = load_engine()
-        generate(engine)
+        engine = load_engine(args)
+        generate(engine, args.rebuild)
+    elif args.search:
+        engine = load_engine(args, verbose=False)
+        search(engine, args.search, args.search_format, args.check)
+    elif args.watch:
+        engine = load_engine(args)
+        watch(engine, args.debounce, args.poll)
+    elif args.reconcile:
+        engine = load_engine(args)
+        reconcile_moved_files(engine, args.prune)
+    elif args.duplicates:
+        engine = load_engine(args)
+        find_duplicates(engine, args.full_hash)
     elif args.tag_all:
-        engine = load_engine()
+        engine = load_engine(args)
         tag_all(engine)
+    elif args.import_tags:
+        engine = load_engine(args)
+        import_tags(engine, args.import_tags, args.import_format)
     elif args.file:
         if not args.file.is_file():
             error(f"invalid file {args.file}")
-        engine = load_engine()
-        tag_file(engine, args.file, False)
+        engine = load_engine(args)
+        try:
+            file_to_tag = engine.resolve_file(args.file)
+        except TagEngineException as e:
+            error(e.message)
+        tag_file(engine, file_to_tag, False)
     else:
         parser.print_help()
         print()